@@ -0,0 +1,139 @@
+import numpy as np
+
+from os import path
+from tempfile import mkdtemp
+from time import time
+
+from scipy.ndimage import gaussian_filter, shift
+
+from sl_xim import readxim
+
+
+class nodisplay():
+    """Stands in for the main window's status line."""
+    class statusline():
+        def set(self, text):
+            pass
+    class tkroot():
+        def update_idletasks(self):
+            pass
+    
+    def __init__(self):
+        self.stackdisp = self.statusline()
+        self.filedisp = self.statusline()
+        self.master = self.tkroot()
+
+def synthstack(nimg, n = 128, drift = 0.02):
+    """Returns a stack of nimg smooth n x n images that drift
+    steadily by the given number of pixels per image."""
+    base = 5000.0 + 2000.0*gaussian_filter(np.random.rand(n, n), 4)
+    base /= base.max()
+    return np.array([10000.0*shift(base, [drift*k, -0.5*drift*k], mode = 'nearest') for k in range(nimg)])
+
+def timeit(func, repeats = 5):
+    """Returns the best wall-clock time of several calls."""
+    best = np.inf
+    for k in range(repeats):
+        t0 = time()
+        func()
+        best = min(best, time() - t0)
+    return best
+
+def benchxim(n = 500):
+    """Compares readxim against np.loadtxt on an n x n image
+    with realistic (5-digit) count values."""
+
+    tmpdir = mkdtemp()
+    ximfile = path.join(tmpdir, 'bench_a000.xim')
+    img = np.random.randint(0, 30000, size = (n, n))
+    np.savetxt(ximfile, img, fmt = '%d', delimiter = '\t')
+
+    assert np.array_equal(readxim(ximfile), np.loadtxt(ximfile)[::-1])
+
+    t_loadtxt = timeit(lambda: np.loadtxt(ximfile)[::-1])
+    t_readxim = timeit(lambda: readxim(ximfile, shape = (n, n)))
+    print('.xim reader, ' + str(n) + 'x' + str(n) + ' image:')
+    print('    np.loadtxt  ' + '%.1f' % (1000*t_loadtxt) + ' ms')
+    print('    readxim     ' + '%.1f' % (1000*t_readxim) + ' ms')
+
+def benchalign(sizes = (100, 300, 1000), n = 128, workers = 0):
+    """Times alignstack on synthetic stacks of several sizes,
+    sequentially and on a pool of worker processes."""
+
+    from sl_proc import alignstack
+
+    print('alignstack, ' + str(n) + 'x' + str(n) + ' images:')
+    for nimg in sizes:
+        raw = synthstack(nimg, n)
+        t_seq = timeit(lambda: alignstack(raw, 0.05, nodisplay(), workers = 1), repeats = 1)
+        t_par = timeit(lambda: alignstack(raw, 0.05, nodisplay(), workers = workers), repeats = 1)
+        print('    ' + str(nimg).rjust(5) + ' images: sequential ' + '%.2f' % t_seq + ' s, parallel ' +
+              '%.2f' % t_par + ' s (' + '%.1f' % (t_seq/t_par) + 'x)')
+
+def benchpyramid(n = 500, ntrials = 20, levels = 2):
+    """Compares full and pyramid registration on n x n images
+    with random shifts of up to 10 pixels. Reports the largest
+    difference between the two and the time per image."""
+
+    from sl_proc import registration
+
+    ref = synthstack(1, n)[0]
+    full = registration(ref, 0.05)
+    pyramid = registration(ref, 0.05, mode = 'pyramid', levels = levels)
+    imgs = [shift(ref, np.random.uniform(-10, 10, 2), mode = 'nearest') for k in range(ntrials)]
+
+    diffs = [np.abs(np.subtract(full.shift(img), pyramid.shift(img))).max() for img in imgs]
+    t_full = timeit(lambda: [full.shift(img) for img in imgs], repeats = 1)/ntrials
+    t_pyramid = timeit(lambda: [pyramid.shift(img) for img in imgs], repeats = 1)/ntrials
+    print('Registration, ' + str(n) + 'x' + str(n) + ' images:')
+    print('    full     ' + '%.1f' % (1000*t_full) + ' ms/image')
+    print('    pyramid  ' + '%.1f' % (1000*t_pyramid) + ' ms/image, max difference ' + '%.4f' % max(diffs) + ' px')
+
+def benchspectrum(nimg = 300, n = 500, roisize = 20000):
+    """Times roispectrum on an nimg-image stack of n x n images
+    with I0 and I regions of roisize pixels each."""
+
+    from sl_proc import roispectrum
+
+    stack = np.random.rand(nimg, n, n)
+    pixels = np.random.permutation(n*n)
+    i0mask = np.zeros((n, n), dtype = bool)
+    itmask = np.zeros((n, n), dtype = bool)
+    i0mask.flat[pixels[:roisize]] = True
+    itmask.flat[pixels[roisize:2*roisize]] = True
+
+    t = timeit(lambda: roispectrum(stack, i0mask, itmask))
+    print('Spectrum, ' + str(nimg) + ' images of ' + str(n) + 'x' + str(n) + ', ' + str(roisize) + '-pixel regions:')
+    print('    roispectrum  ' + '%.1f' % (1000*t) + ' ms')
+
+def benchupsampler(sizes = (128, 256, 500)):
+    """Times the numpy upsampling net on n x n images."""
+
+    from sl_upsample import upsamplenet
+
+    net = upsamplenet('upsample_model.npz')
+    print('Upsampler:')
+    for n in sizes:
+        img = synthstack(1, n)[0].astype(np.float32)
+        t = timeit(lambda: net.predict([[img]]), repeats = 1)
+        print('    ' + str(n).rjust(5) + 'x' + str(n) + '  ' + '%.2f' % t + ' s')
+
+def benchstartup(repeats = 3):
+    """Times importing the processing module, and the main module
+    with everything it imports, in a fresh interpreter each time, as
+    happens when the program starts."""
+
+    import subprocess, sys
+
+    print('Startup:')
+    for label, module in [('import sl_proc', 'sl_proc'), ('import sl_main', 'sl_main')]:
+        t = timeit(lambda: subprocess.run([sys.executable, '-c', 'import ' + module], check = True), repeats = repeats)
+        print('    ' + label + '  ' + '%.2f' % t + ' s')
+
+if __name__ == '__main__':
+    benchxim()
+    benchalign()
+    benchpyramid()
+    benchspectrum()
+    benchupsampler()
+    benchstartup()
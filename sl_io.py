@@ -1,146 +1,376 @@
 import numpy as np
 
 from glob import glob
-from os import path
+from queue import Queue, Empty
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from os import path, remove, replace, stat
 
+from sl_xim import readxim
+
+
+class hdrinfo():
+    """Contents of a STXM .hdr file, read in a single pass.
+    
+    scantype     e.g. 'Image Scan', 'Line Scan'
+    energies     list of energy points (eV)
+    dims         [XRange, YRange, XStep, YStep] for images, or
+                 [energy range, length, points, step] for line scans
+    xdim, ydim   image size (microns)
+    xnpx, ynpx   image size (pixels)
+    shape        shape of each raw image array, (ynpx, xnpx)
+    imgids       three-digit ids of the images acquired so far
+    ringcurrent  storage ring current for each acquired image
+    
+    Fields that do not apply to the scan type are None.
+    """
+    
+    def __init__(self, hdrfile):
+        with open(hdrfile, 'r') as hdr:
+            lines = hdr.readlines()
+        
+        def find(k, cond):
+            while not cond(lines[k]):
+                k += 1
+            return k
+        
+        try:
+            k = find(0, lambda ln: 'ScanDefinition' in ln)
+            self.scantype = lines[k].split(';')[1][9:-1]
+            
+            k = find(k, lambda ln: 'Axis = { Name = \"Energy\"' in ln) + 1
+            ln = lines[k]
+            energies = ln[:ln.index(')')]
+            energies = energies.split(', ')
+            self.energies = [float(en) for en in energies[1:]]
+            
+            if "Line Scan" in self.scantype:
+                k = find(k, lambda ln: 'Axis = { Name = \"Sample\"' in ln)
+                ln = lines[k].split()
+                self.dims = [self.energies[-1] - self.energies[0], float(ln[ln.index('Max')+2][:-1]) - float(ln[ln.index('Min')+2][:-1]), 1.0, 1.0 ]
+                ln = lines[k+1].split()
+                self.dims[2] = int(ln[ln.index('Points')+2][1:-1])
+                self.dims[3] = self.dims[1]/float(self.dims[2])
+            else:
+                k = find(k, lambda ln: 'XRange = ' in ln)
+                ln = lines[k].split()
+                dims = [ln[ln.index(s) + 2] for s in ['XRange', 'YRange', 'XStep', 'YStep']]
+                self.dims = [float(d[:-1]) for d in dims]
+        except (IndexError, ValueError):
+            raise ValueError('Could not parse ' + hdrfile)
+        
+        self.xdim = self.ydim = self.xnpx = self.ynpx = self.shape = None
+        self.ringcurrent = []
+        self.imgids = []
+        
+        try:
+            k = find(0, lambda ln: ln[:12] == '{ CentreXPos')
+            params = lines[k].split(';')
+            self.xdim = float(params[2][9:])
+            self.ydim = float(params[3][9:])
+            self.xnpx = int(params[6][10:])
+            self.ynpx = int(params[7][10:])
+        except (IndexError, ValueError):
+            return
+        
+        if "Line Scan" not in self.scantype:
+            self.shape = (self.ynpx, self.xnpx)
+        
+        # During a live stack the last line may still be being
+        # written, so only complete 'Image' lines are read
+        for ln in lines[k+2:]:
+            if ln[:5] == 'Image':
+                if not (ln.endswith('\n') and ln.rstrip().endswith('};')):
+                    break
+                params = ln.split('; ')
+                try:
+                    ringcurrent = float(params[0][-6:])
+                except ValueError:
+                    raise ValueError('Could not parse ' + hdrfile)
+                self.imgids.append(params[0][5:8])
+                self.ringcurrent.append(ringcurrent)
+
+hdrcache = {}
+
+def readhdr(hdrfile):
+    """Returns an hdrinfo for the given .hdr file. Headers are
+    cached, and only parsed again if the file has changed."""
+    
+    hdrfile = path.abspath(hdrfile)
+    st = stat(hdrfile)
+    key = (st.st_size, st.st_mtime_ns)
+    
+    if hdrfile not in hdrcache or hdrcache[hdrfile][0] != key:
+        hdrcache[hdrfile] = (key, hdrinfo(hdrfile))
+    return hdrcache[hdrfile][1]
 
 def loadstack(hdrfile, master):
     """Takes the full path to a STXM .hdr file as input.
-    Parses the .hdr file to get the energy points and the
-    dimensions of the image(s) and pixels.
+    Parses the .hdr file (see readhdr) to get the energy points
+    and the dimensions of the image(s) and pixels.
     
     Builds a list of all existing raw image files associated
-    with the .hdr file and then loads each file.
+    with the .hdr file and then loads each file. Images that are
+    unchanged since the last time the stack was opened are taken
+    from the binary cache (see readcache); the rest are parsed on
+    a pool of workers (see loadimages).
     
     Returns the list of energies, the image dimensions, a stack
     of raw images, and a list of existing image files.
     """
     
-    with open(hdrfile, 'r') as hdr:
-        ln = hdr.readline()
-        
-        while 'ScanDefinition' not in ln:
-            ln = hdr.readline()
-        scantype = ln.split(';')[1][9:-1]
-        
-        while 'Axis = { Name = \"Energy\"' not in ln:
-            ln = hdr.readline()
-                
-        ln = hdr.readline()
-        energies = ln[:ln.index(')')]
-        energies = energies.split(', ')
-        energies = [float(en) for en in energies[1:]]
-            
-        
-        if "Line Scan" in scantype:
-            while 'Axis = { Name = \"Sample\"' not in ln:
-                ln = hdr.readline()
-            
-            ln = ln.split()
-            dims = [energies[-1] - energies[0], float(ln[ln.index('Max')+2][:-1]) - float(ln[ln.index('Min')+2][:-1]), 1.0, 1.0 ]
-            ln = hdr.readline()
-            ln = ln.split()
-            dims[2] = int(ln[ln.index('Points')+2][1:-1])
-            dims[3] = dims[1]/float(dims[2])
-        
-        else:
-            while 'XRange = ' not in ln:
-                ln = hdr.readline()
-            
-            ln = ln.split()
-            dims = [ln[ln.index(s) + 2] for s in ['XRange', 'YRange', 'XStep', 'YStep']]
-            dims = [float(d[:-1]) for d in dims]
+    hdr = readhdr(hdrfile)
+    energies = hdr.energies
+    dims = hdr.dims
+    scantype = hdr.scantype
     
     workdir = path.dirname(hdrfile)
     prefix = path.basename(hdrfile)[:-4]
     ximlist = glob(path.join(workdir, prefix) + '*.xim')
     ximlist.sort()
     ximlist = [path.abspath(f) for f in ximlist]
-    raw = []
+    
+    usecache = len(energies) > 1 and "Line Scan" not in scantype
+    if usecache:
+        index, cached = readcache(hdrfile)
+    else:
+        index, cached = {}, None
+    
+    raw = [None]*len(ximlist)
+    keys = []
+    shape = hdr.shape
     for k in range(len(ximlist)):
-        master.stackdisp.set('Loading image ' + str(k+1) + '/' + str(len(ximlist)))
+        st = stat(ximlist[k])
+        keys.append((path.basename(ximlist[k]), st.st_size, st.st_mtime_ns))
+        if keys[-1] in index:
+            raw[k] = cached[index[keys[-1]]]
+            shape = raw[k].shape
+    
+    toparse = [k for k in range(len(ximlist)) if raw[k] is None]
+    images = loadimages([ximlist[k] for k in toparse], shape = shape,
+                        workers = master.settings['loadworkers'], pool = master.settings['loadpool'])
+    for n, k in enumerate(toparse):
+        master.stackdisp.set('Loading image ' + str(n+1) + '/' + str(len(toparse)))
         master.master.update_idletasks()
-        raw.append(np.loadtxt(ximlist[k])[::-1])
+        raw[k] = next(images)
+    nparsed = len(toparse)
+    
+    if usecache and len(raw) > 0 and (nparsed > 0 or len(index) != len(raw)):
+        # Images that are already in the cache, in the same place,
+        # stay there; only the images after them are written
+        start = 0
+        while start < len(keys) and index.get(keys[start]) == start:
+            start += 1
+        dtype = cachedtype(raw[start:], cached.dtype if start > 0 else None)
+        if dtype != (cached.dtype if start > 0 else None):
+            start = 0
+            dtype = cachedtype(raw)
+        
+        # Later images taken from the cache would be overwritten
+        for k in range(start, len(raw)):
+            if isinstance(raw[k], np.memmap):
+                raw[k] = np.array(raw[k])
+        master.exports.submit(writecache, hdrfile, keys, raw, start, dtype)
     
     return [energies, dims, raw, ximlist, scantype]
 
-def writencb(master):
-    """Writes stack files (.ncb and .dat) in aXis2000 format."""
+def loadimages(ximlist, shape = None, workers = 0, pool = 'thread'):
+    """Parses a list of .xim files on a pool of worker threads
+    (pool = 'thread') or processes (pool = 'process'), yielding
+    the images in the order of the list as they become available.
+    With workers = 0 the pool has one worker per CPU core; with
+    workers = 1 the files are parsed one at a time without a pool.
     
-    fname = path.join(path.dirname(master.hdrfile), master.stackfname.get())
-    hdrfile = master.hdrfile
-    rawstack = master.data.rawstack
-    energies = master.data.energies
+    All images are expected to have the same shape, so if none is
+    given it is taken from the first file.
+    """
     
-    with open(hdrfile, 'r') as hdr:
-        ln = hdr.readline()
-        
-        while ln[:12] != '{ CentreXPos':
-            ln = hdr.readline()
-        params = ln.split(';')
-        
-        xdim = float(params[2][9:])
-        ydim = float(params[3][9:])
-        xnpx = int(params[6][10:])
-        ynpx = int(params[7][10:])
+    if len(ximlist) == 0:
+        return
+    if shape is None:
+        img = readxim(ximlist[0])
+        shape = img.shape
+        ximlist = ximlist[1:]
+        yield img
+    
+    if workers == 1:
+        for f in ximlist:
+            yield readxim(f, shape = shape)
+        return
+    
+    if pool == 'process':
+        # Worker processes are started afresh rather than forked,
+        # since the program has other threads running by now
+        executor = ProcessPoolExecutor(max_workers = workers or None, mp_context = get_context('spawn'))
+    else:
+        executor = ThreadPoolExecutor(max_workers = workers or None)
+    with executor:
+        for img in executor.map(readxim, ximlist, [shape]*len(ximlist)):
+            yield img
+
+def readsettings(inifile):
+    """Reads the optional 'name = value' lines that follow the data
+    directory in stxmlive_config.txt. Returns a dictionary of
+    settings, with defaults for anything not in the file."""
+    
+    settings = {'loadworkers'  : 0,
+                'loadpool'     : 'thread',
+                'alignworkers' : 1,
+                'registration' : 'full',
+                'pyramidlevels': 2,
+                'livealign'    : 'full',
+                'shiftengine'  : 'spline',
+                'livesave'     : 'progressive',
+                'warmupmodel'  : 0,
+                'linestep'     : 0.05}
+    
+    for ln in inifile:
+        if '=' not in ln or ln.lstrip().startswith('#'):
+            continue
+        name, val = [x.strip() for x in ln.split('=', 1)]
+        for conv in [int, float]:
+            try:
+                val = conv(val)
+                break
+            except ValueError:
+                pass
+        settings[name] = val
+    
+    return settings
+
+def cachefiles(hdrfile):
+    """Returns the names of the binary cache (raw images, one
+    after another) and its index for the stack belonging to a
+    .hdr file."""
+    return [hdrfile[:-4] + '_cache.bin', hdrfile[:-4] + '_cache.idx']
+
+def cachedtype(imgs, dtype = None):
+    """Returns the most compact dtype that holds all the images
+    exactly: uint16 or uint32 for detector counts, and float64
+    otherwise. If a dtype is given and it holds them, it is kept."""
+    
+    def holds(dt):
+        if np.dtype(dt).kind == 'f':
+            return True
+        top = np.iinfo(dt).max
+        return all(img.min() >= 0 and img.max() <= top and np.array_equal(img, np.floor(img)) for img in imgs)
+    
+    for dt in [dtype, np.uint16, np.uint32]:
+        if dt is not None and holds(dt):
+            return np.dtype(dt)
+    return np.dtype(np.float64)
+
+def readcache(hdrfile):
+    """Opens the binary cache of a previously loaded stack.
+    
+    Returns a dictionary mapping (file name, size, mtime) of each
+    cached .xim file to its index in the cache, and the cached
+    images as a copy-on-write memory-mapped (n, ny, nx) array. If there
+    is no usable cache, returns an empty dictionary and None.
+    """
+    
+    binfile, idxfile = cachefiles(hdrfile)
+    index = {}
+    try:
+        with open(idxfile, 'r') as idx:
+            dtype, ny, nx = idx.readline().split()
+            for k, ln in enumerate(idx):
+                name, size, mtime = ln.split()
+                index[(name, int(size), int(mtime))] = k
+        dtype = np.dtype(dtype)
+        shape = (len(index), int(ny), int(nx))
+        if len(index) == 0 or stat(binfile).st_size < np.prod(shape)*dtype.itemsize:
+            return [{}, None]
+        cached = np.memmap(binfile, dtype = dtype, mode = 'c', shape = shape)
+    except (OSError, ValueError, TypeError):
+        return [{}, None]
+    
+    return [index, cached]
+
+def writecache(hdrfile, keys, raw, start = 0, dtype = np.float64):
+    """Writes a stack of raw images to the binary cache as the
+    given dtype, along with an index of the (file name, size,
+    mtime) of each image.
+    
+    The first start images are taken to be in the cache already,
+    so only the images after them are appended. With start = 0
+    the cache is written to a new file that then replaces the old
+    one, which may still be memory-mapped. Failure to write (e.g.
+    a read-only data directory) is ignored.
+    """
+    
+    binfile, idxfile = cachefiles(hdrfile)
+    try:
+        # Remove the old index first so that a partly written
+        # cache can never be mistaken for a valid one
+        if path.exists(idxfile):
+            remove(idxfile)
         
-        ringcurrent = []
-        imgids = []
+        fname = binfile if start > 0 else binfile + '.tmp'
+        with open(fname, 'r+b' if start > 0 else 'wb') as f:
+            f.seek(start*raw[0].size*np.dtype(dtype).itemsize)
+            for img in raw[start:]:
+                img.astype(dtype).tofile(f)
+            f.truncate()
+        if start == 0:
+            replace(fname, binfile)
         
-        hdr.readline()
-        while ln:
-            ln = hdr.readline()
-            if ln[:5] == 'Image':
-                params = ln.split('; ')
-                imgids.append(params[0][5:8])
-                ringcurrent.append(float(params[0][-6:]))
-        
-    imgnames = [hdrfile[:-4] + '_a' + n + '.xim' for n in imgids]
-    print(len(imgnames), len(ringcurrent))
-    # normalize images to ring current 500.0
-    for i in range(len(rawstack)):
-        rawstack[i] *= 500.0
-        rawstack[i] /= ringcurrent[i]
-    
-    alldata = np.array([])
-    for im in rawstack:
-        alldata = np.append(alldata, np.ndarray.flatten(im[::-1]))
-    
-    # check max counts. if possible, scale up by power of 10,
-    # but keep the max counts below 32768 so that output can
-    # be stored as 16-bit integers. if max counts are above
-    # 32768, scale down by power of 10.
-    
-    m = np.max(alldata)
+        with open(idxfile + '.tmp', 'w') as idx:
+            idx.write(np.dtype(dtype).name + ' ' + str(raw[0].shape[0]) + ' ' + str(raw[0].shape[1]) + '\n')
+            for name, size, mtime in keys:
+                idx.write(name + ' ' + str(size) + ' ' + str(mtime) + '\n')
+        replace(idxfile + '.tmp', idxfile)
+    except OSError:
+        pass
+
+def ncbscale(m):
+    """Returns the exponent and the power of ten by which counts
+    with maximum m are scaled before being stored in an .ncb.
+    
+    If possible, the counts are scaled up by a power of 10, but
+    the max counts are kept below 32768 so that the output can be
+    stored as 16-bit integers. If the max counts are above 32768,
+    they are scaled down by a power of 10.
+    """
+    
     scaleexp = np.log10(32767.0/m)
     if scaleexp > 0:
         scaleexp = int(scaleexp)
     else:
         scaleexp = int(scaleexp - 1)
-    scale = (10.0)**scaleexp
+    return [scaleexp, (10.0)**scaleexp]
+
+def ncbframe(img, ringcurrent, scale):
+    """Returns one image as it is stored in an .ncb: normalized
+    to ring current 500.0, scaled, flipped and as 16-bit integers."""
     
-    alldata *= scale
+    frame = img*500.0
+    frame /= ringcurrent
+    frame *= scale
+    return frame[::-1].astype('int16')
+
+def writedat(datname, hdr, scale, energies, imgnames):
+    """Writes the .dat file associated with an .ncb. The pattern is:
     
-    # write .ncb -- just a list of 16-bit integers
-    (alldata.astype('int16')).tofile(fname)
-    
-    # write .dat file associated with .ncb. The pattern is:
-    #
-    #         [# of pixels in x]   [# of pixels in y]    [count scale factor]
-    #         0.00000              [x_width in microns]
-    #         0.00000              [y_width in microns]
-    #         [# of images]
-    #         [energy, image 1   ]
-    #         [energy, image 2   ]
-    #         [    ...           ]
-    #         [energy, last image]
-    #[filename, image 1]     [energy, image 1   ]   2.00  (<--- not sure what the function of this is!)
-    #[filename, image 2]     [energy, image 2   ]   2.00
-    #[    ...                                   ]   2.00
-    #[filename, last image]  [energy, last image]   2.00
-    #
-    
-    datfile = open(fname[:-3] + 'dat', 'w')
+            [# of pixels in x]   [# of pixels in y]    [count scale factor]
+            0.00000              [x_width in microns]
+            0.00000              [y_width in microns]
+            [# of images]
+            [energy, image 1   ]
+            [energy, image 2   ]
+            [    ...           ]
+            [energy, last image]
+    [filename, image 1]     [energy, image 1   ]   2.00  (<--- not sure what the function of this is!)
+    [filename, image 2]     [energy, image 2   ]   2.00
+    [    ...                                   ]   2.00
+    [filename, last image]  [energy, last image]   2.00
+    """
+    
+    xdim, ydim = hdr.xdim, hdr.ydim
+    xnpx, ynpx = hdr.xnpx, hdr.ynpx
+    nimg = len(imgnames)
+    
+    datfile = open(datname, 'w')
 
     datfile.write(' '*(12 - len(str(xnpx))) + str(xnpx))
     datfile.write(' '*(12 - len(str(ynpx))) + str(ynpx))
@@ -152,31 +382,160 @@ def writencb(master):
     datfile.write('     0.000000')
     datfile.write(' '*(13 - len(str(ydim))) + str(ydim) + '\n')
     
-    datfile.write(' '*(12 - len(str(len(rawstack)))) + str(len(rawstack)) + '\n')
+    datfile.write(' '*(12 - len(str(nimg))) + str(nimg) + '\n')
     
-    for i in range(len(rawstack)):
+    for i in range(nimg):
         datfile.write(' '*(13 - len(str(energies[i]))) + str(energies[i]) + '\n')
 
-    for i in range(len(rawstack)):
+    for i in range(nimg):
         datfile.write(imgnames[i][-21:] + '  ' + str(energies[i]))
         if str(energies[i])[-2] == '.':
             datfile.write('0')
         datfile.write('   2.00\n')
     
     datfile.close()
+
+def savencb(fname, hdrfile, rawstack, energies):
+    """Writes stack files (.ncb and .dat) in aXis2000 format for
+    the images in rawstack, normalized to ring current 500.0.
+    
+    The scale factor is found in one pass over the per-image
+    maxima, then the .ncb is streamed to disk one 16-bit frame
+    at a time. rawstack itself is left unchanged.
+    """
+    
+    hdr = readhdr(hdrfile)
+    ringcurrent = np.array(hdr.ringcurrent[:len(rawstack)])
+    imgnames = [hdrfile[:-4] + '_a' + n + '.xim' for n in hdr.imgids]
     
-    master.filedisp.set('Wrote stack file to ' + fname)
+    # Normalizing is monotonic, so the normalized maximum of
+    # each image is just its normalized raw maximum
+    m = np.max(np.max(rawstack, axis = (1, 2))*500.0/ringcurrent)
+    scale = ncbscale(m)[1]
+    
+    # write .ncb -- just a list of 16-bit integers
+    with open(fname, 'wb') as ncb:
+        for img, rc in zip(rawstack, ringcurrent):
+            ncbframe(img, rc, scale).tofile(ncb)
+    
+    writedat(fname[:-3] + 'dat', hdr, scale, energies, imgnames[:len(rawstack)])
 
-def writetxt(master, is_i0 = False):
+class ncbwriter():
+    """Writes an .ncb (and its .dat) one frame at a time while a
+    stack is being acquired, so that the files are complete as
+    soon as the last image arrives.
     
-    if is_i0:
-        fname = path.join(path.dirname(master.hdrfile), master.I0fname.get())
-        yvals = master.data.i0
-    else:
-        fname = path.join(path.dirname(master.hdrfile), master.spectrumfname.get())
-        yvals = master.data.od
+    Frames are scaled with the scale factor of the counts seen so
+    far. If a new image changes the scale exponent, the frames on
+    disk are rewritten from memory; this only happens when the
+    maximum count crosses a power of ten. Images whose ring current
+    is not yet in the .hdr file are held back until it is, and if
+    the ring current of a frame already written changes in the .hdr,
+    that frame is written again. Once every image has been written
+    the files are identical to those from savencb.
+    """
     
-    energies = master.data.energies
+    def __init__(self, fname, hdrfile, energies):
+        self.fname = fname
+        self.hdrfile = hdrfile
+        self.energies = energies
+        self.ringcurrent = []
+        self.framemax = []
+        self.scaleexp = None
+        self.nframes = 0
+    
+    def update(self, rawstack):
+        """Writes the images in rawstack that are not yet on disk (and
+        any whose ring current has changed) and rewrites the .dat.
+        Returns the number of frames in the file."""
+        
+        hdr = readhdr(self.hdrfile)
+        n = min(len(rawstack), len(hdr.ringcurrent))
+        
+        # The first frame that is new, or whose ring current has changed
+        first = self.nframes
+        for k in range(min(n, self.nframes)):
+            if hdr.ringcurrent[k] != self.ringcurrent[k]:
+                first = k
+                break
+        if n <= first:
+            return self.nframes
+        
+        ringcurrent = np.array(hdr.ringcurrent[:n])
+        self.framemax[first:] = list(np.max(rawstack[first:n], axis = (1, 2))*500.0/ringcurrent[first:n])
+        scaleexp, scale = ncbscale(np.max(self.framemax))
+        
+        start = first if scaleexp == self.scaleexp else 0
+        with open(self.fname, 'r+b' if start > 0 else 'wb') as ncb:
+            ncb.seek(2*start*rawstack[0].size)
+            for k in range(start, n):
+                ncbframe(rawstack[k], ringcurrent[k], scale).tofile(ncb)
+            ncb.truncate()
+        self.ringcurrent = list(hdr.ringcurrent[:n])
+        self.scaleexp = scaleexp
+        self.nframes = n
+        
+        imgnames = [self.hdrfile[:-4] + '_a' + i + '.xim' for i in hdr.imgids]
+        writedat(self.fname[:-3] + 'dat', hdr, scale, self.energies, imgnames[:n])
+        return n
+
+class exporter():
+    """Runs file writers on a background thread so that saving
+    never blocks the interface.
+    
+    Writes run one at a time in the order they were submitted, so
+    two writes to the same file never overlap. The arguments must
+    be snapshots that the main thread will not change. Messages
+    about finished (or failed) writes are queued for the main
+    window to show in its status line (see MainWindow.pollexports).
+    """
+    
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers = 1)
+        self.messages = Queue()
+    
+    def submit(self, writer, *args, done = None):
+        """Queues writer(*args). The message done is reported
+        once it has finished; if done is a function, the message
+        is done(result), where result is what the writer returned.
+        Returns a future for the result."""
+        
+        def run():
+            try:
+                result = writer(*args)
+            except Exception as e:
+                # Nobody waits on the result, so report the error
+                # instead of leaving it in the future
+                self.messages.put('Could not save: ' + str(e))
+                return None
+            if callable(done):
+                self.messages.put(done(result))
+            elif done is not None:
+                self.messages.put(done)
+            return result
+        
+        return self.pool.submit(run)
+    
+    def message(self):
+        """Returns the oldest unread message, or None."""
+        try:
+            return self.messages.get_nowait()
+        except Empty:
+            return None
+
+def writencb(master):
+    """Writes stack files (.ncb and .dat) in aXis2000 format
+    in the background."""
+    
+    fname = path.join(path.dirname(master.hdrfile), master.stackfname.get())
+    
+    # Raw images are never modified once loaded, so a view of
+    # them is already a snapshot
+    master.exports.submit(savencb, fname, master.hdrfile, master.data.rawstack, list(master.data.energies),
+                          done = 'Wrote stack file to ' + fname)
+
+def savetxt(fname, energies, yvals):
+    """Writes a spectrum (or I0) as an aXis2000 text file."""
     
     outfile = open(fname, 'w')
     outfile.write('% 1d\n')
@@ -186,33 +545,43 @@ def writetxt(master, is_i0 = False):
     for i in range(len(yvals)):
         outfile.write('\t' + str(energies[i]) + '\t' + str(yvals[i]) + '\n')
     outfile.close()
+
+def writetxt(master, is_i0 = False):
     
     if is_i0:
-        master.filedisp.set('Wrote I0 to ' + fname)
+        fname = path.join(path.dirname(master.hdrfile), master.I0fname.get())
+        yvals = master.data.i0
+        done = 'Wrote I0 to ' + fname
     else:
-        master.filedisp.set('Wrote spectrum to ' + fname)
+        fname = path.join(path.dirname(master.hdrfile), master.spectrumfname.get())
+        yvals = master.data.od
+        done = 'Wrote spectrum to ' + fname
+    
+    master.exports.submit(savetxt, fname, list(master.data.energies), np.array(yvals), done = done)
 
-def writealn(master):
-    fname = path.join(path.dirname(master.hdrfile), master.alnfname.get())
+def savealn(fname, imgfile, energies, shifts):
+    """Writes the shifts of an aligned stack to an aXis2000 .aln file."""
     
     fout = open(fname, 'w')
     
     fout.write('! Alignment file generated by STXM Live Analysis\n')
     fout.write('! X-Y Pixel shifts after alignment\n')
     fout.write('! Full images used\n')
-    fout.write('! Aligned to first image, ' + path.basename(master.data.imgfile[0]) + '  ' + str(master.data.energies[0]) + ' eV\n')
+    fout.write('! Aligned to first image, ' + path.basename(imgfile[0]) + '  ' + str(energies[0]) + ' eV\n')
     fout.write('! Correlation maximum determined by peak\n')
     fout.write('! No edge enhancement\n')
     fout.write('! Upsample factor 1000\n')
     fout.write('! Gaussian smoothing of 3 pixels\n')
     fout.write('ALIGN(0,0,0,0,1000,0.001,3,0,0,0,0,-1\n')
-    fout.write('PLOTIT(' + str(len(master.data.shifts)) + '\n')
+    fout.write('PLOTIT(' + str(len(shifts)) + '\n')
     
-    for i in range(len(master.data.shifts)):
-        fout.write(path.basename(master.data.imgfile[i]) + '  ' + str(master.data.energies[i]) + '   ' + '2.00,')
-        fout.write(str(master.data.shifts[i][0]) + ',' + str(master.data.shifts[i][1]) + '\n')
+    for i in range(len(shifts)):
+        fout.write(path.basename(imgfile[i]) + '  ' + str(energies[i]) + '   ' + '2.00,')
+        fout.write(str(shifts[i][0]) + ',' + str(shifts[i][1]) + '\n')
     
-    master.filedisp.set('Wrote alignment file to ' + fname)
-    master.update_idletasks()
+    fout.close()
 
-    fout.close()
\ No newline at end of file
+def writealn(master):
+    fname = path.join(path.dirname(master.hdrfile), master.alnfname.get())
+    master.exports.submit(savealn, fname, list(master.data.imgfile), list(master.data.energies), np.array(master.data.shifts),
+                          done = 'Wrote alignment file to ' + fname)
\ No newline at end of file
@@ -3,23 +3,29 @@ import tkinter.filedialog as fdialog
 
 import numpy as np
 
-from time import time, sleep
-from threading import Timer
+from time import time
+from queue import Queue, Empty
+from threading import Thread
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, FileSystemEvent
 
-from os import path
+from os import path, stat
 from platform import system
 from sl_ui import *
 from sl_io import *
 from sl_proc import *
+from sl_xim import readxim
 
 
 
 class stxmdata():        
     def clear(self):
-        self.rawstack = []
-        self.alnstack = []
+        self.rawbuf = np.zeros((0,2,2))
+        self.alnbuf = np.zeros((0,2,2))
+        self.nimg = 0
+        self.linegrid = np.array([[0,0],[0,0]])
+        self.reg = None
+        self.spec = None
         self.rawimg = np.array([[0,0],[0,0]])
         self.displayimg = np.array([[0,0],[0,0]])
         self.overlayimg = np.array([[0,0],[0,0]])
@@ -30,23 +36,176 @@ class stxmdata():
         self.i0 = [0,0]
         self.it = [0,0]
         self.od = [0,0]
-        self.i0px = []
-        self.itpx = []
-        self.backupit = []
+        self.i0mask = np.zeros((2,2), dtype = bool)
+        self.itmask = np.zeros((2,2), dtype = bool)
+        self.backupit = np.zeros((2,2), dtype = bool)
         self.bdypx = []
         self.keeppx = np.array([[0,0],[0,0]])
     
+    def allocate(self, nimg, shape):
+        """Preallocates contiguous (nimg, ny, nx) arrays to hold
+        the raw and aligned images of the whole stack."""
+        self.rawbuf = np.zeros((nimg,) + tuple(shape))
+        self.alnbuf = np.zeros((nimg,) + tuple(shape))
+        self.nimg = 0
+    
+    def nextslot(self):
+        """Returns the index at which the next image will be stored,
+        enlarging the arrays if the stack is already full."""
+        if self.nimg == len(self.rawbuf):
+            n = max(1, len(self.rawbuf))
+            self.rawbuf = np.concatenate([self.rawbuf, np.zeros_like(self.rawbuf[:n])])
+            self.alnbuf = np.concatenate([self.alnbuf, np.zeros_like(self.alnbuf[:n])])
+        return self.nimg
+    
+    @property
+    def rawstack(self):
+        """(n, ny, nx) view of the raw images loaded so far."""
+        return self.rawbuf[:self.nimg]
+    
+    @property
+    def alnstack(self):
+        """(n, ny, nx) view of the aligned images loaded so far."""
+        return self.alnbuf[:self.nimg]
+    
     def __init__(self):
         self.clear()
 
 
 class stackhandler(FileSystemEventHandler):
-    def __init__(self, appwindow):
-        self.app = appwindow
-        self.app.livestack()
+    """Puts the names of new or changed files in a queue, along
+    with whether the file has been closed after writing."""
+    def __init__(self, events):
+        self.events = events
     def on_created(self, event):
-        sleep(0.1)
-        self.app.livestack()
+        if not event.is_directory:
+            self.events.put((event.src_path, False))
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.events.put((event.src_path, False))
+    def on_closed(self, event):
+        # Only reported on some platforms (inotify)
+        if not event.is_directory:
+            self.events.put((event.src_path, True))
+
+
+class incompleteimage(ValueError):
+    """Raised when a new image file does not hold a whole image yet."""
+    pass
+
+def prepareimage(ximfile, shape, reg, livealign, engine):
+    """Reads a new image of a live stack, finds its shift against
+    the registration reg (with liveshift if livealign is 'predict')
+    and aligns it with the given engine. Runs on the acquisition
+    worker, so everything it uses is passed in rather than read from
+    the main window. Raises incompleteimage if the file does not hold
+    a whole image yet."""
+    
+    try:
+        img = readxim(ximfile, shape = shape)
+    except (OSError, ValueError):
+        # Still being written (or, on Windows, still locked by the writer)
+        raise incompleteimage(ximfile + ' is incomplete')
+    if img.shape != shape:
+        raise incompleteimage(ximfile + ' is incomplete')
+    
+    if livealign == 'predict':
+        newshift = reg.liveshift(img)
+    else:
+        newshift = reg.shift(img)
+    aligned, valid = alignoneimage(img, newshift, engine = engine)
+    return [img, newshift, aligned, valid]
+
+class acquisition():
+    """Watches the directory of a live stack and prepares each new
+    image on a worker thread.
+    
+    File events go into a queue. An image is taken to be complete
+    once it has been closed after writing, or its size has stopped
+    changing. Complete images are passed in name order to
+    prepare(ximfile) on the worker thread, and the results are
+    queued for the main window to collect (see MainWindow.livestack).
+    If prepare raises incompleteimage, the image is tried again once
+    its size changes; any other error is queued in place of the
+    result. Images already seen are kept in a set, so the work per
+    event does not grow with the number of files in the directory.
+    """
+    
+    def __init__(self, hdrfile, known, prepare, settle = 0.05):
+        self.prefix = hdrfile[:-4]
+        self.known = set(path.abspath(f) for f in known)
+        self.prepare = prepare
+        self.settle = settle
+        self.events = Queue()
+        self.results = Queue()
+        self.running = True
+        
+        self.observer = Observer()
+        self.observer.schedule(stackhandler(self.events), path.dirname(hdrfile))
+        self.observer.start()
+        self.worker = Thread(target = self.run, daemon = True)
+        self.worker.start()
+        
+        # Catch images written before the observer started
+        for f in glob(self.prefix + '*.xim'):
+            self.events.put((f, False))
+    
+    def stop(self):
+        self.running = False
+        self.observer.stop()
+    
+    def run(self):
+        # Last size seen of each unfinished image (None once closed)
+        pending = {}
+        # Size at which an image could not be read
+        failed = {}
+        
+        while self.running:
+            try:
+                event = self.events.get(timeout = self.settle)
+                while True:
+                    (f, closed) = event
+                    f = path.abspath(f)
+                    if f.startswith(self.prefix) and f.endswith('.xim') and f not in self.known:
+                        if closed:
+                            pending[f] = None
+                        elif f not in pending:
+                            pending[f] = -1
+                    event = self.events.get_nowait()
+            except Empty:
+                pass
+            
+            # Sizes are compared one settle interval apart
+            ready = []
+            for f in list(pending):
+                try:
+                    size = stat(f).st_size
+                except OSError:
+                    del pending[f]
+                    continue
+                if (pending[f] is None or size == pending[f] > 0) and failed.get(f) != size:
+                    ready.append((f, size))
+                else:
+                    pending[f] = size
+            
+            for (f, size) in sorted(ready):
+                if not self.running:
+                    return
+                try:
+                    result = self.prepare(f)
+                except incompleteimage:
+                    # Not completely written after all; try again once it changes
+                    failed[f] = pending[f] = size
+                    continue
+                except Exception as e:
+                    # Let the main window report it; the image is only
+                    # tried again if it changes
+                    failed[f] = pending[f] = size
+                    self.results.put((f, e))
+                    continue
+                del pending[f]
+                self.known.add(f)
+                self.results.put((f, result))
 
 
 class MainWindow(tk.Frame):
@@ -82,7 +241,10 @@ class MainWindow(tk.Frame):
         self.imgdisplay.redraw(self)
 
     def sethdr(self, hfile):
+        # The acquisition worker must not see the new stack
+        self.stopacquisition()
         self.data.clear()
+        self.livencb = None
         self.filedisp.set('')
         
         self.hdrfile = path.abspath(hfile)
@@ -93,10 +255,8 @@ class MainWindow(tk.Frame):
         self.starttime = path.getctime(self.hdrfile)
         
         self.stackdisp.set('Loading...')
-        self.data.energies, self.data.imgdims, self.data.rawstack, self.data.imgfile, self.data.scantype = loadstack(hfile, self)
+        self.data.energies, self.data.imgdims, raw, self.data.imgfile, self.data.scantype = loadstack(hfile, self)
         self.data.estrlen = max([len(str(x)) for x in self.data.energies])
-        self.data.rawimg = self.data.rawstack[-1]
-        self.data.overlayimg = np.zeros_like(self.data.rawimg)
         
         if "Line Scan" in self.data.scantype:
             self.mode = 'linescan'
@@ -107,6 +267,21 @@ class MainWindow(tk.Frame):
         else:
             self.mode = 'stack'
         
+        if self.mode == 'linescan':
+            self.data.allocate(len(raw), raw[0].shape)
+        else:
+            self.data.allocate(max(len(self.data.energies), len(raw)), raw[0].shape)
+        for k in range(len(raw)):
+            self.data.rawbuf[k] = raw[k]
+        self.data.nimg = len(raw)
+        del raw
+        
+        self.data.rawimg = self.data.rawstack[-1]
+        self.data.overlayimg = np.zeros_like(self.data.rawimg)
+        self.data.i0mask = np.zeros(self.data.rawimg.shape, dtype = bool)
+        self.data.itmask = np.zeros(self.data.rawimg.shape, dtype = bool)
+        self.data.backupit = np.zeros(self.data.rawimg.shape, dtype = bool)
+        
         if self.mode == 'linescan':
             self.imglabels = [path.basename(self.data.imgfile[0]) + '     Line Scan']
         else:            
@@ -117,26 +292,30 @@ class MainWindow(tk.Frame):
                 self.imglabels.append(f)
         
         if self.mode == 'linescan':
-            self.data.alnstack = [regridlinescan(self.data.rawstack[0], self.data.energies, self.data.imgdims)]
-            self.data.overlayimg = np.zeros_like(self.data.alnstack[0])
+            self.data.linegrid = regridlinescan(self.data.rawstack[0], self.data.energies, self.data.imgdims,
+                                                step = self.settings['linestep'])
+            self.data.overlayimg = np.zeros_like(self.data.linegrid)
+        
+        if self.mode == 'map' or self.mode == 'stack':
+            self.data.reg = registration(self.data.rawstack[0], self.data.imgdims[3], mode = self.settings['registration'],
+                                         levels = self.settings['pyramidlevels'])
+        
+        if self.mode == 'map':
+            self.data.shifts = np.zeros((1,2))
+            self.data.alnbuf[0] = self.data.rawbuf[0]
         
         if self.mode == 'map' and len(self.data.rawstack) == 2:
             self.stackdisp.set('Generating map...')
-            self.data.shifts = [[0,0], calculate_shift(self.data.rawstack[0], self.data.rawstack[1], self.data.imgdims[3])]
-            self.data.alnstack = [self.data.rawstack[0], alignoneimage(self.data.rawstack[1], self.data.shifts[1])]
+            self.data.shifts = np.array([[0,0], self.data.reg.shift(self.data.rawstack[1])])
+            self.data.alnbuf[1] = alignoneimage(self.data.rawstack[1], self.data.shifts[1], engine = self.settings['shiftengine'])[0]
             self.data.eltmap = genmap(self.data.rawstack, self.data.shifts[1])
             self.specdisplay.showmap()
             self.stackdisp.set('Map complete')
         
         if self.mode == 'stack':
             # Align stack
-            [self.data.shifts, self.data.alnstack] = alignstack(self.data.rawstack, self.data.imgdims[3], self)
-            # Keep track of which pixels have
-            # drifted out of field of view
-            self.data.keeppx = np.ones_like(self.data.rawstack[0])
-            for im in self.data.alnstack:
-                mask = 1 - 1*(im == -1)
-                self.data.keeppx *= mask
+            self.data.shifts = alignstack(self.data.rawstack, self.data.imgdims[3], self, out = self.data.alnstack, reg = self.data.reg,
+                                          workers = self.settings['alignworkers'], engine = self.settings['shiftengine'])[0]
             
             self.data.i0 = np.zeros(len(self.data.rawstack))
             self.data.it = np.zeros(len(self.data.rawstack))
@@ -144,28 +323,38 @@ class MainWindow(tk.Frame):
         
         self.setxim(ind = len(self.data.imgfile) - 1)
         self.stackdisp.set('')
+        
+        # Get suggestions ready in case they are asked for
+        if self.mode == 'single':
+            self.suggestions.start(self.data.imgfile[0], self.data.imgdims)
 
         self.data.keeppx = np.ones_like(self.data.rawstack[0])
         if self.mode == 'map' or self.mode == 'stack':
-            # Keep track of pixels that are okay to keep after alignment
-            for k in range(len(self.data.rawstack)):
-                self.data.keeppx *= (self.data.alnstack[-1] != -1)
+            # Keep track of which pixels have
+            # drifted out of field of view
+            shape = self.data.rawstack[0].shape
+            keep = np.ones(shape, dtype = bool)
+            for sh in self.data.shifts:
+                keep &= validmask(shape, sh)
+            self.data.keeppx = 1.0*keep
             
-            # Start watchdog observer to automatically load new images
+            # Start watching for new images
             if len(self.data.energies) > len(self.data.rawstack):
+                self.data.reg.seed(self.data.shifts)
                 self.stackrunning = True
                 self.chkpoint = time()
-                self.refresh = Timer(1.0, self.timeleft).start()
-                self.event_handler = stackhandler(self)
-                self.newimage.schedule(self.event_handler, path.dirname(self.hdrfile))
-                self.newimage.start()
+                self.framedt = self.frametime()
+                
+                # Bind what the worker needs now, so that it never reads
+                # the settings or the data of a stack loaded later
+                reg, livealign, engine = self.data.reg, self.settings['livealign'], self.settings['shiftengine']
+                self.acq = acquisition(self.hdrfile, self.data.imgfile, lambda f: prepareimage(f, shape, reg, livealign, engine))
+                self.after(200, lambda acq = self.acq: self.livestack(acq))
             else:
                 self.stackrunning = False
-                self.newimage.stop()
                 self.stackdisp.set('')
         else:
             self.stackrunning = False
-            self.newimage.stop()
         
         self.setfnames()
         self.enablectrls()
@@ -181,9 +370,14 @@ class MainWindow(tk.Frame):
             hdrlist = [ (path.basename(h), h) for h in hdrlist ]
             hdrlist.sort()
             
-            newhdrfile = hdrlist[-1][1]
-            
-            self.sethdr(path.abspath(newhdrfile))
+            # Skip any header that is still being written
+            for h in hdrlist[::-1]:
+                try:
+                    readhdr(h[1])
+                except (OSError, ValueError):
+                    continue
+                self.sethdr(path.abspath(h[1]))
+                break
            
     def addtoroi(self, roiid):
         self.config(cursor = 'plus')
@@ -203,95 +397,102 @@ class MainWindow(tk.Frame):
             pass
         
         else:
-            self.data.i0px, self.data.itpx, self.data.overlayimg = autoseg(self.data, int(self.bdyentry.get()))
-            self.data.backupit = self.data.itpx[:]
+            self.data.i0mask, self.data.itmask, self.data.overlayimg = autoseg(self.data, int(self.bdyentry.get()))
+            self.data.backupit = self.data.itmask.copy()
         
         self.genI0IT()
         
     def clearroi(self, roiid):
         if roiid == 1:
-            self.data.i0px = []
+            removed = self.data.i0mask.copy()
+            self.data.i0mask[:] = False
         else:
-            self.data.itpx = []
-        self.data.backupit = []
+            removed = self.data.itmask.copy()
+            self.data.itmask[:] = False
+        self.data.backupit[:] = False
         
         mask = roiid*(self.data.overlayimg == roiid)
         self.data.overlayimg -= mask
                 
         self.imgdisplay.redraw(self)
-        self.genI0IT()
+        self.updateroi(roiid, removed = removed)
     
     def odfilter(self):
         if len([x for x in self.data.od if x != 0.0]) > 0:
-            curr_i0 = np.mean(np.array([self.data.displayimg[p[0]][p[1]] for p in self.data.i0px]))
+            curr_i0 = np.mean(self.data.displayimg[self.data.i0mask])
             odminv = float(self.odmin.get())
             odmaxv = float(self.odmax.get())
             
-            self.data.itpx = [p for p in self.data.backupit if np.log(curr_i0/self.data.displayimg[p[0]][p[1]]) < odmaxv]
-            self.data.itpx = [p for p in self.data.itpx if np.log(curr_i0/self.data.displayimg[p[0]][p[1]]) > odminv]
+            # OD of every pixel of the displayed frame, computed once
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                odimg = np.log(curr_i0/self.data.displayimg)
             
-            for p in self.data.backupit:
-                if p in self.data.itpx:
-                    self.data.overlayimg[p[0]][p[1]] = -1
-                else:
-                    self.data.overlayimg[p[0]][p[1]] = 0
+            oldit = self.data.itmask
+            newit = self.data.backupit & (odimg < odmaxv) & (odimg > odminv)
+            self.data.itmask = newit
+            
+            self.data.overlayimg[self.data.backupit] = 0
+            self.data.overlayimg[newit] = -1
+            
+            self.updateroi(-1, added = newit & ~oldit, removed = oldit & ~newit)
+        else:
+            self.genI0IT()
+    
+    def spectrumstack(self):
+        """Returns the stack that spectra are computed from (raw or
+        aligned) and a boolean mask of the pixels that may be used."""
+        if self.autoalign.get() == 0 or self.mode == 'single':
+            return [self.data.rawstack, np.ones(self.data.rawstack[0].shape, dtype = bool)]
+        return [self.data.alnstack, self.data.keeppx == 1]
+    
+    def updateroi(self, roiid, added = None, removed = None):
+        """Updates the spectra after pixels (given as boolean masks)
+        have been added to or removed from the I0 (roiid = 1) or
+        I (roiid = -1) region, using only those pixels."""
+        
+        spec = self.data.spec
+        if self.mode not in ['stack', 'single'] or spec is None or len(spec) != len(self.data.rawstack):
+            self.genI0IT()
+            return
+        
+        my_stack, keep = self.spectrumstack()
+        if removed is not None:
+            spec.removepixels(my_stack, roiid, removed)
+        if added is not None:
+            spec.addpixels(my_stack, roiid, added & keep)
+        self.data.i0, self.data.it, self.data.od = spec.spectra()
         
-        self.genI0IT()
+        self.imgdisplay.redraw(self)
+        if self.mode == 'stack':
+            self.specdisplay.replotspec()
     
     def genI0IT(self):
         
         if self.mode == 'stack' or self.mode == 'single':
-            if self.autoalign.get() == 0 or self.mode == 'single':
-                my_stack = self.data.rawstack
-                my_i0px = self.data.i0px
-                my_itpx = self.data.itpx
-            else:
-                my_stack = self.data.alnstack
-                my_i0px = [p for p in self.data.i0px if self.data.keeppx[p[0]][p[1]] == 1]
-                my_itpx = [p for p in self.data.itpx if self.data.keeppx[p[0]][p[1]] == 1]
-            
-            self.data.i0 = np.zeros(len(my_stack))
-            self.data.it = np.zeros(len(my_stack))
-            
-            for i in range(len(my_stack)):
-                for p in my_i0px:
-                    self.data.i0[i] += my_stack[i][p[0]][p[1]]
-                for p in my_itpx:
-                    self.data.it[i] += my_stack[i][p[0]][p[1]]
+            my_stack, keep = self.spectrumstack()
+            i0mask = self.data.i0mask & keep
+            itmask = self.data.itmask & keep
             
-            if len(my_itpx) != 0:
-                self.data.it /= np.float(len(my_itpx))
-            if len(my_i0px) != 0:
-                self.data.i0 /= np.float(len(my_i0px))
-            
-            if len(my_i0px) == 0 or len(my_itpx) == 0:
-                self.data.od = np.zeros(len(my_stack))
-            else:
-                self.data.od = np.log( self.data.i0/self.data.it )
+            self.data.spec = spectrumsums(my_stack, i0mask, itmask)
+            self.data.i0, self.data.it, self.data.od = self.data.spec.spectra()
                 
         if self.mode == 'linescan':
-            n_i0 = 0
-            n_it = 0
-            self.data.i0 = np.zeros_like(self.data.rawstack[0][0])
-            self.data.it = np.zeros_like(self.data.rawstack[0][0])
-            
-            a = len(self.data.rawstack[0])
-            
-            for i in range(a):
-                if self.data.overlayimg[i][0] == 1.0:
-                    n_i0 += 1
-                    self.data.i0 += self.data.rawstack[0][i]
-                elif self.data.overlayimg[i][0] == -1.0:
-                    n_it += 1
-                    self.data.it += self.data.rawstack[0][i]
+            # Each row of a line scan is one position along the line
+            line = self.data.rawstack[0]
+            i0rows = (self.data.overlayimg[:, 0] == 1.0)
+            itrows = (self.data.overlayimg[:, 0] == -1.0)
+            n_i0 = np.count_nonzero(i0rows)
+            n_it = np.count_nonzero(itrows)
             
+            self.data.i0 = np.zeros_like(line[0])
+            self.data.it = np.zeros_like(line[0])
             if n_i0 != 0:
-                self.data.i0 /= n_i0
+                self.data.i0 = line[i0rows].mean(axis = 0)
             if n_it != 0:
-                self.data.it /= n_it
+                self.data.it = line[itrows].mean(axis = 0)
             
             if n_i0 == 0 or n_it == 0:
-                self.data.od = np.zeros_like(self.data.rawstack[0][0])
+                self.data.od = np.zeros_like(line[0])
             else:
                 self.data.od = np.log( self.data.i0/self.data.it )
         
@@ -359,22 +560,30 @@ class MainWindow(tk.Frame):
         writetxt(self)
         writetxt(self, is_i0 = True)
         writealn(self)
-        self.filedisp.set('Wrote files to ' + path.dirname(self.hdrfile))
+        self.exports.submit(lambda: None, done = 'Wrote files to ' + path.dirname(self.hdrfile))
     
-    def addxim(self, ximfile):
+    def pollexports(self):
+        """Shows messages from the background writer in the
+        status line."""
+        msg = self.exports.message()
+        while msg is not None:
+            self.filedisp.set(msg)
+            msg = self.exports.message()
+        self.after(200, self.pollexports)
+    
+    def addxim(self, ximfile, img, newshift, aligned, valid):
+        ind = self.data.nextslot()
         self.data.imgfile.append(ximfile)
-        self.data.rawstack.append(np.loadtxt(ximfile)[::-1])
-        ind = len(self.data.imgfile) - 1
+        self.data.rawbuf[ind] = img
+        self.data.nimg += 1
         
         zeropad = self.data.estrlen - len(str(self.data.energies[ind]))
         f = path.basename(ximfile) + '     ' + str(self.data.energies[ind]) + '0'*zeropad + ' eV'
         self.imglabels.append(f)
         
-        self.data.shifts = np.append( self.data.shifts, [calculate_shift(self.data.rawstack[0], self.data.rawstack[-1], self.data.imgdims[3])], axis = 0 )
-        self.data.alnstack.append( alignoneimage(self.data.rawstack[-1], self.data.shifts[-1]) )
-        
-        mask = 1 - 1*(self.data.alnstack[-1] == -1)
-        self.data.keeppx *= mask
+        self.data.shifts = np.append( self.data.shifts, [newshift], axis = 0 )
+        self.data.alnbuf[ind] = aligned
+        self.data.keeppx *= valid
         
         if self.imgselect.get() == self.imglabels[-2]:
             ii = len(self.data.rawstack)-1
@@ -382,49 +591,121 @@ class MainWindow(tk.Frame):
             ii = self.imglabels.index(self.imgselect.get())
         
         self.setxim(ind = ii)
-        self.genI0IT()
+        if self.mode == 'stack':
+            self.addtospectrum()
+            if self.autosave.get() == 1 and self.settings['livesave'] == 'progressive':
+                self.savelive()
+        else:
+            self.genI0IT()
     
-    def timeleft(self, return_time=False):
-        if self.stackrunning:
-            tlist = [path.getctime(f) for f in self.data.imgfile]
-            for i in range(len(tlist)-1, 0, -1):
-                tlist[i] -= tlist[i-1]
-            tlist[0] -= self.starttime
-            dt = np.mean(np.array(tlist))
-            
-            tleft = dt*(len(self.data.energies) - len(self.data.rawstack)) - (time() - self.chkpoint)
-            sec = str(int(tleft)%60)
-            if len(sec) == 1:
-                sec = '0' + sec
-            self.stackdisp.set('Stack running... ' + str(int(tleft/60)) + ':' + sec + ' remaining')
-            if return_time:
-                return dt
-            
-            Timer(1.0, self.timeleft).start()
-    
-    def livestack(self):
-        if self.stackrunning:
-            ximlist = glob(path.join(path.dirname(self.hdrfile), '*.xim'))
-            ximlist = [f for f in ximlist if f not in self.data.imgfile]
-            ximlist.sort()
-            for f in ximlist:
-                self.addxim(f)
-                self.chkpoint = time()
-            
-            my_dt = self.timeleft(return_time=True)
+    def savelive(self):
+        """Brings the partial .ncb/.dat and .aln files of a live
+        stack up to date with the images acquired so far. Returns
+        a future for the number of frames now in the .ncb."""
+        
+        fname = path.join(path.dirname(self.hdrfile), self.stackfname.get())
+        if self.livencb is None or self.livencb.fname != fname:
+            self.livencb = ncbwriter(fname, self.hdrfile, self.data.energies)
+        
+        # The writer only reads images that are already complete
+        total = str(len(self.data.energies))
+        job = self.exports.submit(self.livencb.update, self.data.rawstack,
+                                  done = lambda n: 'Saved ' + str(n) + ' of ' + total + ' images to ' + fname)
+        self.exports.submit(savealn, path.join(path.dirname(self.hdrfile), self.alnfname.get()), list(self.data.imgfile),
+                            list(self.data.energies), np.array(self.data.shifts))
+        return job
+    
+    def finishlive(self, job, tries = 30):
+        """Waits for the last update of a live .ncb, and writes it
+        again every second while frames are still held back because
+        their ring currents are not yet in the .hdr file."""
+        
+        writer = self.livencb
+        if writer is None:
+            return
+        if not job.done():
+            self.after(200, lambda: self.finishlive(job, tries) if self.livencb is writer else None)
+        elif writer.nframes < len(self.data.energies):
+            if tries > 0:
+                self.after(1000, lambda: self.finishlive(self.savelive(), tries - 1) if self.livencb is writer else None)
+            else:
+                self.filedisp.set('Saved ' + str(writer.nframes) + ' of ' + str(len(self.data.energies)) +
+                                  ' images: ring currents missing from ' + path.basename(self.hdrfile))
+    
+    def addtospectrum(self):
+        """Adds the newest image of a live stack to the spectra
+        without recomputing the earlier points. Those are only
+        changed if ROI pixels have drifted out of the field of view."""
+        
+        spec = self.data.spec
+        if spec is None or len(spec) != len(self.data.rawstack) - 1:
+            self.genI0IT()
+            return
+        
+        if self.autoalign.get() == 0:
+            spec.addimage(self.data.rawstack[-1])
+        else:
+            spec.restrict(self.data.alnstack[:-1], self.data.keeppx == 1)
+            spec.addimage(self.data.alnstack[-1])
+        self.data.i0, self.data.it, self.data.od = spec.spectra()
+        
+        self.imgdisplay.redraw(self)
+        self.specdisplay.replotspec()
+    
+    def frametime(self):
+        """Returns the mean time taken per image so far. The time
+        between consecutive images adds up to the time from the start
+        of the stack to the newest image, so only that one is checked."""
+        return (path.getctime(self.data.imgfile[-1]) - self.starttime)/len(self.data.imgfile)
+    
+    def timeleft(self):
+        tleft = self.framedt*(len(self.data.energies) - len(self.data.rawstack)) - (time() - self.chkpoint)
+        sec = str(int(tleft)%60)
+        if len(sec) == 1:
+            sec = '0' + sec
+        self.stackdisp.set('Stack running... ' + str(int(tleft/60)) + ':' + sec + ' remaining')
+    
+    def stopacquisition(self):
+        if self.acq is not None:
+            self.acq.stop()
+            self.acq = None
+    
+    def livestack(self, acq):
+        """Adds the images prepared by the acquisition worker to the
+        stack. Runs on the Tk thread every 200 ms while the stack
+        is running."""
+        
+        if acq is not self.acq or not self.stackrunning:
+            return
+        
+        added = False
+        while True:
+            try:
+                ximfile, result = acq.results.get_nowait()
+            except Empty:
+                break
+            if isinstance(result, Exception):
+                self.filedisp.set('Could not add ' + path.basename(ximfile) + ': ' + str(result))
+                continue
+            self.addxim(ximfile, *result)
+            added = True
+        if added:
+            self.chkpoint = time()
+            self.framedt = self.frametime()
             
         if len(self.data.imgfile) == len(self.data.energies):
             self.stackrunning = False
-            if self.refresh is not None:
-                self.refresh.cancel()
-            self.newimage.stop()
+            self.stopacquisition()
             
             if self.mode == 'stack':
                 self.stackdisp.set('Stack complete')
                 
                 if self.autosave.get() == 1:
-                    writencb(self)
-                    writealn(self)
+                    if self.settings['livesave'] == 'progressive':
+                        self.finishlive(self.savelive())
+                    else:
+                        writencb(self)
+                        writealn(self)
                     if self.mode == 'stack':
                         writetxt(self)
                         writetxt(self, is_i0 = True)
@@ -435,15 +716,50 @@ class MainWindow(tk.Frame):
                     self.data.map = genmap(self.data.rawimg[0], self.data.rawimg[1])
                 self.stackdisp.set('Map complete')
         
-        elif time() - self.chkpoint > max(3.0*my_dt, 10.0):
+        elif time() - self.chkpoint > max(3.0*self.framedt, 10.0):
             self.stackdisp.set('Timed out -- stack aborted or files not found')
             self.stackrunning = False
-            if self.refresh is not None:
-                self.refresh.cancel()
-            self.newimage.stop()
+            self.stopacquisition()
+        
+        else:
+            self.timeleft()
+            self.after(200, lambda: self.livestack(acq))
     
     def show_suggestions(self):
-        reg = predict_regions(self.data.rawimg, self.data.imgdims)
+        # Clicks while suggestions are being computed are ignored,
+        # so that only one poll is ever waiting for them
+        if self.suggesting:
+            return
+        
+        ximfile = self.data.imgfile[self.imglabels.index(self.imgselect.get())]
+        try:
+            result = self.suggestions.start(ximfile, self.data.imgdims)
+        except OSError as e:
+            self.stackdisp.set('Could not find regions: ' + str(e))
+            return
+        self.suggesting = True
+        self.drawsuggestions(ximfile, result)
+    
+    def drawsuggestions(self, ximfile, result):
+        """Draws the suggestions for an image once they are ready,
+        polling every 100 ms until then."""
+        
+        if not result.done():
+            self.stackdisp.set('Finding regions...')
+            self.after(100, lambda: self.drawsuggestions(ximfile, result))
+            return
+        self.suggesting = False
+        
+        try:
+            reg = result.result()
+        except (ImportError, OSError, ValueError) as e:
+            self.stackdisp.set('Could not find regions: ' + str(e))
+            return
+        self.stackdisp.set('')
+        
+        # Another image may have been chosen in the meantime
+        if ximfile not in self.data.imgfile or self.data.imgfile.index(ximfile) != self.imglabels.index(self.imgselect.get()):
+            return
         self.imgdisplay.img.autoscale(False)
         for y,x,a in reg:
             w = np.sqrt(a)*2.5
@@ -503,12 +819,16 @@ class MainWindow(tk.Frame):
         with open('stxmlive_config.txt', 'r') as inifile:
             self.hdrfile = inifile.readline()
             self.workdir = path.dirname(self.hdrfile)
+            self.settings = readsettings(inifile)
         
         self.data = stxmdata()
         self.mode = 'single'
         self.stackrunning = False
-        self.refresh = None
-        self.newimage = Observer()
+        self.acq = None
+        self.livencb = None
+        self.exports = exporter()
+        self.suggestions = suggester()
+        self.suggesting = False
         
         makefilepicker(self)
         makeimgcontrols(self)
@@ -522,6 +842,12 @@ class MainWindow(tk.Frame):
         self.autosavechk.toggle()
         
         self.setcommands()
+        self.pollexports()
+        
+        # Optionally load the upsampler while the window is idle,
+        # so that the first suggestion does not have to wait for it
+        if self.settings['warmupmodel'] == 1:
+            self.after_idle(lambda: Thread(target = getupsampler, daemon = True).start())
     
 if __name__ == '__main__':
     root = tk.Tk()
@@ -1,91 +1,352 @@
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from os import path, stat
+from threading import Lock
+
 from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage.fourier import fourier_shift
 from scipy.ndimage.interpolation import shift
 from scipy.ndimage.morphology import binary_erosion
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 from skimage.feature import register_translation
 from skimage.filters import sobel, threshold_otsu
-from skimage.measure import regionprops
 from skimage.morphology import label
 from skimage.io import imsave
 
-import keras
-upsampler = keras.models.load_model('upsample_model.h5')
+from sl_upsample import exportupsampler, upsamplenet
+from sl_xim import readxim
+
+upsampler = None
+upsamplerlock = Lock()
+
+def getupsampler():
+    """Returns the neural net used to upsample images for region
+    suggestions, loading it the first time it is needed. The net
+    runs on numpy (see sl_upsample); its weights are exported from
+    upsample_model.h5 if upsample_model.npz is missing."""
+    global upsampler
+    with upsamplerlock:
+        if upsampler is None:
+            if not path.exists('upsample_model.npz'):
+                exportupsampler('upsample_model.h5', 'upsample_model.npz')
+            upsampler = upsamplenet('upsample_model.npz')
+    return upsampler
+
+def upsampled_dft(data, rows, cols):
+    """Evaluates the inverse Fourier transform of a 2D spectrum
+    at arbitrary (sub-pixel) row and column positions, by direct
+    matrix multiplication. This is much cheaper than upsampling
+    the whole image when only a small window is needed."""
+    (ny, nx) = data.shape
+    rowkern = np.exp(2j*np.pi*np.outer(rows, np.fft.fftfreq(ny)))
+    colkern = np.exp(2j*np.pi*np.outer(np.fft.fftfreq(nx), cols))
+    return rowkern.dot(data).dot(colkern)/(nx*ny)
+
+def downsample(img, factor):
+    """Averages an image over factor x factor blocks, discarding
+    any leftover rows and columns."""
+    (a, b) = (img.shape[0]//factor, img.shape[1]//factor)
+    return img[:a*factor, :b*factor].reshape(a, factor, b, factor).mean(axis = (1, 3))
+
+class registration():
+    """Aligns images to a fixed reference image using the
+    registration algorithm from scikit-image, to within 0.01
+    pixels or 1 nm, whichever is coarser.
+    
+    The smoothed reference and its Fourier transforms (with and
+    without a Sobel filter) are computed once and reused for
+    every image registered against it.
+    
+    With mode = 'pyramid', the shift is first found on images
+    downsampled by 2**levels, then refined at full resolution on
+    successively finer grids around that estimate (see
+    pyramidshift). More levels are faster, but can miss the
+    correct peak in images with little large-scale structure.
+    
+    During a live stack, liveshift uses the recent shift history
+    to narrow the search for each new image.
+    """
+    
+    def __init__(self, ref, pxwidth, mode = 'full', levels = 2):
+        self.sigma = min(0.15/pxwidth, 3.0)
+        self.upsample = min(1000.0, 100.0/pxwidth)
+        self.filtref = gaussian_filter(ref, self.sigma)
+        self.mode = mode
+        self.levels = levels
+        self.reffft = {}
+        self.coarsefft = {}
+        
+        # For liveshift
+        self.history = []
+        self.quality = None
+        self.window = 2
+        self.tolerance = 0.9
+    
+    def refimage(self, edges):
+        """The smoothed reference, with a Sobel filter applied
+        if edges is True."""
+        if edges:
+            return sobel(self.filtref)
+        return self.filtref
+    
+    def refspectrum(self, edges):
+        """Fourier transform of the smoothed reference, with
+        a Sobel filter applied if edges is True."""
+        if edges not in self.reffft:
+            self.reffft[edges] = np.fft.fftn(self.refimage(edges))
+        return self.reffft[edges]
+    
+    def coarsespectrum(self, edges):
+        """Fourier transform of the downsampled reference."""
+        if edges not in self.coarsefft:
+            self.coarsefft[edges] = np.fft.fftn(downsample(self.refimage(edges), 2**self.levels))
+        return self.coarsefft[edges]
+    
+    def prepare(self, img):
+        """Smooths an image and decides whether to align using
+        edges. Returns the filtered image and that decision."""
+        filt = gaussian_filter(img, self.sigma)
+        
+        thr = threshold_otsu(filt)
+        edgecheck = 1*(filt < thr)
+        # Check whether the object lies along a boundary of the image,
+        # and if so apply a Sobel filter to use edges to align
+        (a, b) = edgecheck.shape
+        edgects = [np.sum(edgecheck[0])/float(b), np.sum(edgecheck[-1])/float(b), np.sum(edgecheck[:,0])/float(a), np.sum(edgecheck[:,-1])/float(a)]
+        edges = max(edgects) > 0.4
+        if edges:
+            filt = sobel(filt)
+        return [filt, edges]
+    
+    def refine(self, product, est, npts):
+        """Searches for the correlation peak pixel by pixel within
+        npts pixels of an estimated row, column shift, then zooms in
+        on the peak with a fixed number of points per step until the
+        step reaches the target precision. The last, finest grid is
+        snapped to multiples of 1/upsample, so that it samples the same
+        points as register_translation does.
+        
+        Returns the shift, the height of the correlation peak, and
+        whether the pixel-level peak lay on the edge of the window
+        (in which case the true peak is probably outside it).
+        """
+        
+        step = 1.0
+        while True:
+            rows = est[0] + step*np.arange(-npts, npts + 1)
+            cols = est[1] + step*np.arange(-npts, npts + 1)
+            cc = np.abs(upsampled_dft(product, rows, cols))
+            (i, j) = np.unravel_index(np.argmax(cc), cc.shape)
+            est = np.array([rows[i], cols[j]])
+            if step == 1.0:
+                onedge = max(abs(i - npts), abs(j - npts)) == npts
+            if step <= 1.0/self.upsample:
+                break
+            npts = 8
+            step = 1.5*step/npts
+            if step <= 1.0/self.upsample:
+                step = 1.0/self.upsample
+                est = np.round(est*self.upsample)/self.upsample
+        
+        return [np.round(est*self.upsample)/self.upsample, cc[i, j], onedge]
+    
+    def pyramidshift(self, filt, edges, filtfft):
+        """Returns the row, column shift between the filtered image
+        and the reference, found on downsampled images and then
+        refined around that estimate at full resolution."""
+        
+        factor = 2**self.levels
+        coarse = np.fft.ifftn(self.coarsespectrum(edges)*np.conj(np.fft.fftn(downsample(filt, factor))))
+        peak = np.array(np.unravel_index(np.argmax(np.abs(coarse)), coarse.shape), dtype = float)
+        size = np.array(coarse.shape)
+        peak[peak > size//2] -= size[peak > size//2]
+        
+        # The coarse estimate is good to within one coarse pixel
+        product = self.refspectrum(edges)*np.conj(filtfft)
+        return self.refine(product, factor*peak, factor)[0]
+    
+    def fullshift(self, filt, edges, filtfft):
+        """Returns the row, column shift between the filtered image
+        and the reference, using the registration mode chosen."""
+        if self.mode == 'pyramid':
+            return self.pyramidshift(filt, edges, filtfft)
+        return register_translation(self.refspectrum(edges), filtfft,
+                                    upsample_factor = self.upsample, space = 'fourier')[0]
+    
+    def shift(self, img):
+        """Returns the x,y shift (in pixels) that aligns img
+        with the reference."""
+        filt, edges = self.prepare(img)
+        shift = self.fullshift(filt, edges, np.fft.fftn(filt))
+        return [-shift[1], shift[0]]
+    
+    def seed(self, shifts):
+        """Sets the shift history used by liveshift from a list
+        of x,y shifts (e.g. those found by alignstack)."""
+        self.history = [np.array([sh[1], -sh[0]]) for sh in shifts]
+    
+    def liveshift(self, img):
+        """Like shift, but for images arriving one at a time during
+        a stack. Stage drift changes smoothly from one energy to the
+        next, so the shift is predicted from the previous two and
+        only refined within a few pixels of the prediction.
+        
+        Falls back to a full search if the refined peak lies at the
+        edge of the window or is much weaker (relative to the image
+        norms) than the last peak found by a full search.
+        """
+        
+        filt, edges = self.prepare(img)
+        filtfft = np.fft.fftn(filt)
+        product = self.refspectrum(edges)*np.conj(filtfft)
+        # By Cauchy-Schwarz, correlation peaks are at most this high
+        norm = np.sqrt(np.sum(np.abs(self.refspectrum(edges))**2)*np.sum(np.abs(filtfft)**2))/filt.size
+        
+        shift = None
+        if len(self.history) >= 2 and self.quality is not None:
+            pred = 2*self.history[-1] - self.history[-2]
+            est, peak, onedge = self.refine(product, pred, self.window)
+            if not onedge and peak/norm >= self.tolerance*self.quality:
+                shift = est
+        
+        if shift is None:
+            shift = np.array(self.fullshift(filt, edges, filtfft))
+            self.quality = np.abs(upsampled_dft(product, shift[:1], shift[1:]))[0, 0]/norm
+        
+        self.history.append(shift)
+        return [-shift[1], shift[0]]
 
 def calculate_shift(imgA, imgB, pxwidth):
     """Uses the registration algorithm from scikit-image
     to calculate alignment to within 0.01 pixels or 1 nm,
     whichever is coarser."""
     
-    sigma = 0.15/pxwidth
-    filtA = gaussian_filter(imgA, min(sigma, 3.0))
-    filtB = gaussian_filter(imgB, min(sigma, 3.0))
-    
-    thr = threshold_otsu(filtB)
-    edgecheck = 1*(filtB < thr)
-    # Check whether the object lies along a boundary of the image,
-    # and if so apply a Sobel filter to use edges to align
-    (a, b) = edgecheck.shape
-    edgects = [np.sum(edgecheck[0])/float(b), np.sum(edgecheck[-1])/float(b), np.sum(edgecheck[:,0])/float(a), np.sum(edgecheck[:,-1])/float(a)]
-    if max(edgects) > 0.4:
-        filtA = sobel(filtA)
-        filtB = sobel(filtB)
-    
-    shift = register_translation(filtA, filtB, upsample_factor = min(1000.0, 100.0/pxwidth))
-    return [-shift[0][1], shift[0][0]]
-
-def alignoneimage(img, sh):
-    """Given an image and x,y shifts in pixels, returns a
-    shifted image in which pixels beyond the boundaries of
-    the original image have their values set to -1.
-    """
-    aligned = shift(img, [sh[1], -sh[0]], mode = 'nearest')
+    return registration(imgA, pxwidth).shift(imgB)
+
+def validmask(shape, sh):
+    """Given an image shape and x,y shifts in pixels, returns a
+    boolean mask that is False for pixels of the shifted image
+    that lie beyond the boundaries of the original image."""
     
-    (u, v) = img.shape
+    valid = np.ones(shape, dtype = bool)
+    (u, v) = shape
     
     if sh[1] >= 0.5:
-        irange = range(int(sh[1])+1)
+        valid[:int(sh[1])+1] = False
     elif sh[1] <= -0.5:
-        irange = range(u - int(-sh[1]), u)
-    else:
-        irange = []
-    for i in irange:
-        for j in range(v):
-            aligned[i][j] = -1
+        valid[u - int(-sh[1]):] = False
     
     if sh[0] >= 0.5:
-        jrange = range(v - int(sh[0]), v)
+        valid[:, v - int(sh[0]):] = False
     elif sh[0] <= -0.5:
-        jrange = range(int(-sh[0])+1)
+        valid[:, :int(-sh[0])+1] = False
+    
+    return valid
+
+def alignoneimage(img, sh, engine = 'spline'):
+    """Given an image and x,y shifts in pixels, returns the
+    shifted image and a boolean mask of the pixels that lie
+    within the boundaries of the original image.
+    
+    The image is shifted by spline interpolation, or with
+    engine = 'fourier' by a phase ramp applied to its Fourier
+    transform.
+    """
+    
+    if engine == 'fourier':
+        aligned = np.fft.ifftn(fourier_shift(np.fft.fftn(img), [sh[1], -sh[0]])).real
     else:
-        jrange = []
-    for i in range(u):
-        for j in jrange:
-            aligned[i][j] = -1
-        
-    return aligned
+        aligned = shift(img, [sh[1], -sh[0]], mode = 'nearest')
+    
+    return [aligned, validmask(img.shape, sh)]
+
+# Per-process state of the alignstack worker pool
+alignworker = {}
 
-def alignstack(raw, pxwidth, master):
+def initalignworker(rawname, alnname, shape, reg, engine):
+    """Attaches a pool worker to the shared raw and aligned
+    stacks used by alignstack."""
+    rawshm = SharedMemory(name = rawname)
+    alnshm = SharedMemory(name = alnname)
+    alignworker['shm'] = [rawshm, alnshm]
+    alignworker['raw'] = np.ndarray(shape, dtype = np.float64, buffer = rawshm.buf)
+    alignworker['aln'] = np.ndarray(shape, dtype = np.float64, buffer = alnshm.buf)
+    alignworker['reg'] = reg
+    alignworker['engine'] = engine
+
+def alignworkerimage(k):
+    """Aligns image k of the shared stack in a pool worker."""
+    raw = alignworker['raw']
+    sh = alignworker['reg'].shift(raw[k])
+    alignworker['aln'][k] = alignoneimage(raw[k], sh, engine = alignworker['engine'])[0]
+    return [k, sh]
+
+def alignstack(raw, pxwidth, master, out = None, reg = None, workers = 1, engine = 'spline'):
     """Given a stack of images and the width of each pixel (in
     microns), calculates the shifts needed to align all images
     with the highest-contrast image in the stack.
     
     Returns the list of shifts and a stack of aligned images.
-    Pixels beyond the boundaries of the original images have
-    their values set to -1.
+    If an (n, ny, nx) output array is given, the aligned images
+    are written into it. A registration against raw[0] may be
+    passed in to reuse its cached reference. The images are
+    shifted with the given engine (see alignoneimage); use
+    validmask to find the pixels that stay in the field of view.
+    
+    With workers other than 1, the images are aligned on a pool
+    of processes (0 = one per CPU core) sharing the stack. The
+    processes are spawned rather than forked, as forking while the
+    acquisition, export and suggestion threads run is unsafe.
     """
     
-    shifts = np.array([[0.0, 0.0] for k in range(len(raw))])
-    aligned = [np.zeros_like(raw[0]) for k in range(len(raw))]
-    aligned[0] = raw[0][::]
+    shifts = np.zeros((len(raw), 2))
+    if out is None:
+        aligned = np.zeros((len(raw),) + raw[0].shape)
+    else:
+        aligned = out
+    aligned[0] = raw[0]
+    if reg is None:
+        reg = registration(raw[0], pxwidth)
+    
+    if workers == 1 or len(raw) < 3:
+        for k in range(1, len(raw)):
+            master.stackdisp.set('Calculating shifts... ' + str(k+1) + '/' + str(len(raw)))
+            master.master.update_idletasks()
+            shtmp = reg.shift(raw[k])
+            shifts[k] += np.array(shtmp)
+            aligned[k] = alignoneimage(raw[k], shifts[k], engine = engine)[0]
+        return [shifts, aligned]
+    
+    shape = (len(raw),) + raw[0].shape
+    nbytes = int(np.prod(shape))*8
+    rawshm = SharedMemory(create = True, size = nbytes)
+    alnshm = SharedMemory(create = True, size = nbytes)
+    try:
+        np.ndarray(shape, dtype = np.float64, buffer = rawshm.buf)[...] = raw
+        alnshared = np.ndarray(shape, dtype = np.float64, buffer = alnshm.buf)
+        
+        with ProcessPoolExecutor(max_workers = workers or None, mp_context = get_context('spawn'),
+                                 initializer = initalignworker,
+                                 initargs = (rawshm.name, alnshm.name, shape, reg, engine)) as pool:
+            jobs = [pool.submit(alignworkerimage, k) for k in range(1, len(raw))]
+            for n, job in enumerate(as_completed(jobs)):
+                master.stackdisp.set('Calculating shifts... ' + str(n+2) + '/' + str(len(raw)))
+                master.master.update_idletasks()
+                k, shtmp = job.result()
+                shifts[k] += np.array(shtmp)
+        
+        aligned[1:] = alnshared[1:]
+        del alnshared
+    finally:
+        for shm in [rawshm, alnshm]:
+            shm.close()
+            shm.unlink()
     
-    for k in range(1, len(raw)):
-        master.stackdisp.set('Calculating shifts... ' + str(k+1) + '/' + str(len(raw)))
-        master.master.update_idletasks()
-        shtmp = calculate_shift(raw[0], raw[k], pxwidth)
-        shifts[k] += np.array(shtmp)
-        aligned[k] = alignoneimage(raw[k], shifts[k])
     return [shifts, aligned]
 
 def genmap(raw, shift):
@@ -101,90 +362,251 @@ def genmap(raw, shift):
     I0_1 = np.mean([x for x in fl_1 if x > thr_1])
     
     od_0 = np.log(I0_0/raw[0])
-    od_1 = alignoneimage(np.log(I0_1/raw[1]), shift)
+    od_1, valid = alignoneimage(np.log(I0_1/raw[1]), shift)
     
     map_out = od_1 - od_0
-    mask = 1.0 - 1.0*(od_1 == -1)
+    mask = 1.0*valid
     
     return map_out*mask
 
+class spectrumsums():
+    """Sums of each image of an (n, ny, nx) stack over boolean
+    masks of the I0 and I regions.
+    
+    The sums are kept up to date as images are added (addimage)
+    and as pixels drift out of the field of view (restrict), so
+    the spectra never have to be recomputed from the whole stack.
+    """
+    
+    def __init__(self, stack, i0mask, itmask):
+        self.i0mask = i0mask.copy()
+        self.itmask = itmask.copy()
+        
+        # One pass over the stack: a matrix product with the masks
+        weights = np.zeros((i0mask.size, 2))
+        weights[:, 0] = i0mask.ravel()
+        weights[:, 1] = itmask.ravel()
+        self.sums = stack.reshape(len(stack), -1).dot(weights)
+    
+    def __len__(self):
+        return len(self.sums)
+    
+    def addimage(self, img):
+        """Adds the sums for one new image."""
+        newsums = [np.sum(img[self.i0mask]), np.sum(img[self.itmask])]
+        self.sums = np.append(self.sums, [newsums], axis = 0)
+    
+    def restrict(self, stack, keep):
+        """Removes pixels outside the boolean mask keep from both
+        regions, subtracting their contributions from the sums of
+        the images already in the stack."""
+        for k, mask in enumerate([self.i0mask, self.itmask]):
+            dropped = mask & ~keep
+            if np.any(dropped):
+                self.sums[:, k] -= stack[:, dropped].sum(axis = 1)
+                mask &= keep
+    
+    def addpixels(self, stack, roiid, mask):
+        """Adds the pixels of a boolean mask to the I0 (roiid = 1)
+        or I (roiid = -1) region, adding only their contributions
+        to the sums."""
+        region = self.i0mask if roiid == 1 else self.itmask
+        added = mask & ~region
+        if np.any(added):
+            self.sums[:, 0 if roiid == 1 else 1] += stack[:, added].sum(axis = 1)
+            region |= added
+    
+    def removepixels(self, stack, roiid, mask):
+        """Removes the pixels of a boolean mask from the I0
+        (roiid = 1) or I (roiid = -1) region, subtracting only
+        their contributions from the sums."""
+        k = 0 if roiid == 1 else 1
+        region = self.i0mask if roiid == 1 else self.itmask
+        removed = mask & region
+        if np.array_equal(removed, region):
+            self.sums[:, k] = 0.0
+        elif np.any(removed):
+            self.sums[:, k] -= stack[:, removed].sum(axis = 1)
+        region &= ~removed
+    
+    def spectra(self):
+        """Returns the average I0 and I in each image and the OD
+        spectrum (zero if either region is empty)."""
+        n_i0 = np.count_nonzero(self.i0mask)
+        n_it = np.count_nonzero(self.itmask)
+        i0 = self.sums[:, 0]/max(n_i0, 1)
+        it = self.sums[:, 1]/max(n_it, 1)
+        
+        if n_i0 == 0 or n_it == 0:
+            od = np.zeros(len(self.sums))
+        else:
+            od = np.log(i0/it)
+        
+        return [i0, it, od]
+
+def roispectrum(stack, i0mask, itmask):
+    """Given an (n, ny, nx) stack and boolean masks of the I0
+    and I regions, returns the average I0 and I in each image
+    and the OD spectrum (zero if either region is empty)."""
+    return spectrumsums(stack, i0mask, itmask).spectra()
+
 def autoseg(dataset, bdy):
     """Given a dataset class (see sl_main for the definition),
     automatically segments using Otsu's method and returns
-    regions with a boundary with width of the specified
-    number of pixels."""
+    boolean masks of the I0 and I regions, separated by a
+    boundary with width of the specified number of pixels,
+    and the overlay image (1 for I0, -1 for I)."""
 
     thr = threshold_otsu(dataset.rawimg)
+    keep = (dataset.keeppx == 1)
     
-    i0_mask = (dataset.displayimg > thr)*(dataset.keeppx)
+    i0_mask = (dataset.displayimg > thr) & keep
     if int(bdy/2) + bdy%2 > 0:
-        i0_mask = 1*binary_erosion(i0_mask, iterations = int(bdy/2) + bdy%2, border_value = 1)
+        i0_mask = binary_erosion(i0_mask, iterations = int(bdy/2) + bdy%2, border_value = 1)
     
-    it_mask = (dataset.displayimg < thr)*(dataset.keeppx)
+    it_mask = (dataset.displayimg < thr) & keep
     if int(bdy/2) > 0:
-        it_mask = 1*binary_erosion(it_mask, iterations = int(bdy/2), border_value = 0)
+        it_mask = binary_erosion(it_mask, iterations = int(bdy/2), border_value = 0)
     
-    (a,b) = i0_mask.shape
-    my_i0px = []
-    my_itpx = []
-    for i in range(a):
-        for j in range(b):
-            if i0_mask[i][j] == 1:
-                my_i0px.append([i,j])
-            if it_mask[i][j] == 1:
-                my_itpx.append([i,j])
-    
-    return([my_i0px, my_itpx, i0_mask - it_mask])
+    return([i0_mask, it_mask, 1.0*i0_mask - 1.0*it_mask])
 
-def regridlinescan(rawimg, energies, dims):
-    """Re-grids a line scan image for display with pyplot.imshow."""
-    tmp = rawimg.T
+def regridlinescan(rawimg, energies, dims, step = 0.05):
+    """Re-grids a line scan image for display with pyplot.imshow,
+    onto a uniform energy axis with the given step (eV). Each
+    column of the new grid is the column of the first energy point
+    at or below that energy."""
     
-    newgrid = [tmp[0]]
+    energies = np.asarray(energies)
     
-    en = energies[0]
-    k = 1
-    while k < len(energies):
-        while en < energies[k]:
-            newgrid = np.append(newgrid, [tmp[k-1]], axis = 0)
-            en += 0.05
-        k += 1
+    # Grid energies are accumulated step by step, as they always have been,
+    # so that columns fall on exactly the same side of each energy point
+    n = int((energies[-1] - energies[0])/step) + 2
+    grid = np.cumsum(np.concatenate([[energies[0]], np.full(n, step)]))
+    grid = grid[grid < energies[-1]]
     
-    newgrid = newgrid.T
+    cols = np.searchsorted(energies, grid, side = 'right') - 1
+    newgrid = rawimg[:, np.concatenate([[0], cols])]
     
     return(newgrid)
 
-def predict_regions(rawimg, dims):
+def labelstrips(img, lo, hi, rows = 256):
+    """Finds the (8-connected) regions where lo < img < hi, labelling
+    one strip of rows at a time so that only one strip of labels is
+    held in memory. Regions that touch across strips are merged.
+    
+    Returns the area and the centroid row and column of each region,
+    in the order in which label would number them.
+    """
+    
+    (ny, nx) = img.shape
+    counts, rowsums, colsums, firsts, pairs = [], [], [], [], []
+    nlab = 0
+    prevrow = None
+    
+    for r in range(0, ny, rows):
+        strip = img[r:r + rows]
+        lab, n = label((strip > lo) & (strip < hi), connectivity = 2, return_num = True)
+        
+        (ii, jj) = np.nonzero(lab)
+        ids = lab[ii, jj] - 1
+        counts.append(np.bincount(ids, minlength = n))
+        rowsums.append(np.bincount(ids, weights = ii + r, minlength = n))
+        colsums.append(np.bincount(ids, weights = jj, minlength = n))
+        # np.nonzero is in raster order, so the first pixel of each label comes first
+        firstpx = np.unique(ids, return_index = True)[1]
+        firsts.append((ii[firstpx] + r)*nx + jj[firstpx])
+        
+        # Pair up labels that touch across the seam, including diagonally
+        if prevrow is not None:
+            for d in [-1, 0, 1]:
+                a = prevrow[max(-d, 0):nx - max(d, 0)]
+                b = lab[0, max(d, 0):nx - max(-d, 0)]
+                both = (a > 0) & (b > 0)
+                pairs.append(np.array([a[both] - 1, b[both] - 1 + nlab]))
+        prevrow = np.where(lab[-1] > 0, lab[-1] + nlab, 0)
+        nlab += n
+    
+    if nlab == 0:
+        return [np.zeros(0), np.zeros(0), np.zeros(0)]
+    
+    pairs = np.concatenate(pairs, axis = 1) if pairs else np.zeros((2, 0), dtype = int)
+    links = coo_matrix((np.ones(pairs.shape[1]), (pairs[0], pairs[1])), shape = (nlab, nlab))
+    ncomp, comp = connected_components(links, directed = False)
+    
+    first = np.full(ncomp, ny*nx)
+    np.minimum.at(first, comp, np.concatenate(firsts))
+    order = np.argsort(first)
+    
+    area = np.bincount(comp, weights = np.concatenate(counts), minlength = ncomp)[order]
+    rowsum = np.bincount(comp, weights = np.concatenate(rowsums), minlength = ncomp)[order]
+    colsum = np.bincount(comp, weights = np.concatenate(colsums), minlength = ncomp)[order]
+    return [area, rowsum/area, colsum/area]
+
+def predict_regions(rawimg, dims, tile = 128, workers = 0):
     """Given an image and dimensions, predicts an upsampled version
     and returns centroids of regions with (a) OD between 0.5 and 1.5
-    and (b) area at least 1 um^2."""
+    and (b) area at least 1 um^2.
+    
+    The image is upsampled in tiles (see upsamplenet.tiled) and the
+    regions are labelled in strips (see labelstrips), so that memory
+    use stays bounded for large images."""
     
     # Apply neural net upsampling
-    imgin = np.array([[rawimg]]).astype(np.float32)
-    usamp = upsampler.predict(imgin)[0,0]
+    usamp = getupsampler().tiled(np.asarray(rawimg, dtype = np.float32), tile = tile, workers = workers)
         
-    # Convert to OD
+    # 0.5 < OD < 1.5, without building an OD image
+    # Mean of the bright pixels, without copying them out
     thr = threshold_otsu(usamp)
-    myi0 = np.mean(usamp[usamp>thr])
-    usampOD = np.log(myi0/usamp)
-    
-    mask = (usampOD>0.5)*(usampOD<1.5)
-    a = (4*rawimg.shape[0]-usampOD.shape[0])//2
-    b = (4*rawimg.shape[1]-usampOD.shape[1])//2
-    mask = np.pad(mask, ((a,a),(b,b)), mode='constant')
-    reg = regionprops(label(mask))
+    bright = usamp > thr
+    myi0 = usamp.sum(where = bright, dtype = np.float64)/np.count_nonzero(bright)
+    del bright
+    
+    a = (4*rawimg.shape[0]-usamp.shape[0])//2
+    b = (4*rawimg.shape[1]-usamp.shape[1])//2
+    area, rows, cols = labelstrips(usamp, myi0*np.exp(-1.5), myi0*np.exp(-0.5))
     okcentroids = []
     
-    for r in reg:
-        scaledarea = r.area*dims[2]*dims[3]/16
+    for k in range(len(area)):
+        scaledarea = area[k]*dims[2]*dims[3]/16
         if scaledarea>1:
-            okcentroids.append([r.centroid[0]*dims[2]/4,
-                                r.centroid[1]*dims[3]/4,
+            okcentroids.append([(rows[k] + a)*dims[2]/4,
+                                (cols[k] + b)*dims[3]/4,
                                 scaledarea])
     
     okcentroids.sort(key=lambda ca: -ca[2])
     
     return okcentroids[:10]
 
+class suggester():
+    """Computes region suggestions (see predict_regions) on a
+    background thread as soon as an image is loaded, so that they
+    are ready by the time they are asked for.
+    
+    Results are kept for the most recent images, keyed by file name,
+    size and modification time, so an image that changes on disk is
+    computed again. The image is read from the file by the worker, so
+    the result always belongs to the file that the key describes.
+    """
+    
+    def __init__(self, maxsize = 20):
+        self.pool = ThreadPoolExecutor(max_workers = 1)
+        self.results = {}
+        self.maxsize = maxsize
+    
+    def key(self, ximfile):
+        st = stat(ximfile)
+        return (path.abspath(ximfile), st.st_size, st.st_mtime_ns)
+    
+    def start(self, ximfile, dims):
+        """Starts computing suggestions for an image file, unless they
+        are already known. Returns the future holding them."""
+        
+        k = self.key(ximfile)
+        if k not in self.results:
+            self.results[k] = self.pool.submit(lambda dims = list(dims): predict_regions(readxim(ximfile), dims))
+            while len(self.results) > self.maxsize:
+                del self.results[next(iter(self.results))]
+        return self.results[k]
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -109,32 +109,46 @@ class ImgFrame(tk.Frame):
     
     def lassofinish(self):
         (a, b) = self.master.data.overlayimg.shape
+        (dx, dy) = self.master.data.imgdims[2:4]
         
+        # Row i from the bottom of the display is row a-i-1 of the image
         if self.master.mode == 'linescan':
-            for i in range(a):
-                if self.master.data.overlayimg[a-i-1][0] == 0.0:
-                    if i*self.master.data.imgdims[3] <= max(self.lassopts[0][1], self.lassopts[1][1]):
-                        if i*self.master.data.imgdims[3] >= min(self.lassopts[0][1], self.lassopts[1][1]):
-                            for j in range(b):
-                                self.master.data.overlayimg[a-i-1][j] = self.lassoroiid
+            ypos = dy*np.arange(a)[::-1]
+            band = (ypos <= max(self.lassopts[0][1], self.lassopts[1][1])) & (ypos >= min(self.lassopts[0][1], self.lassopts[1][1]))
+            band &= (self.master.data.overlayimg[:, 0] == 0.0)
+            self.master.data.overlayimg[band, :] = self.lassoroiid
         
         else:
             lassopath = mplpath.Path(self.lassopts + [self.lassopts[-1]], closed = True)
+            added = np.zeros((a, b), dtype = bool)
             
-            for i in range(a):
-                for j in range(b):
-                    if self.master.data.overlayimg[a-i-1][j] == 0.0 and lassopath.contains_point([j*self.master.data.imgdims[2],i*self.master.data.imgdims[3]]):
-                        self.master.data.overlayimg[a-i-1][j] = self.lassoroiid
-                        if self.lassoroiid == 1:
-                            self.master.data.i0px.append([a-i-1,j])
-                        else:
-                            self.master.data.itpx.append([a-i-1,j])
-                            self.master.data.backupit = self.master.data.itpx[:]
+            # Only pixels within the lasso's bounding box can be inside it
+            pts = np.array(self.lassopts)
+            j0 = max(int(np.floor(pts[:, 0].min()/dx)), 0)
+            j1 = min(int(np.ceil(pts[:, 0].max()/dx)) + 1, b)
+            i0 = max(int(np.floor(pts[:, 1].min()/dy)), 0)
+            i1 = min(int(np.ceil(pts[:, 1].max()/dy)) + 1, a)
+            
+            if j1 > j0 and i1 > i0:
+                (jj, ii) = np.meshgrid(np.arange(j0, j1), np.arange(i0, i1))
+                inside = lassopath.contains_points(np.column_stack([dx*jj.ravel(), dy*ii.ravel()]))
+                added[a-i1:a-i0, j0:j1] = inside.reshape(jj.shape)[::-1]
+                added &= (self.master.data.overlayimg == 0.0)
+                self.master.data.overlayimg[added] = self.lassoroiid
+            
+            if self.lassoroiid == 1:
+                self.master.data.i0mask |= added
+            else:
+                self.master.data.itmask |= added
+                self.master.data.backupit = self.master.data.itmask.copy()
                 
         self.redraw(self.master)
         self.master.enablectrls()
         
-        self.master.genI0IT()
+        if self.master.mode == 'linescan':
+            self.master.genI0IT()
+        else:
+            self.master.updateroi(self.lassoroiid, added = added)
 
 
 class SpecFrame(tk.Frame):
@@ -0,0 +1,153 @@
+import numpy as np
+
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import as_strided
+from os import cpu_count
+
+
+def conv2d(x, kernel, bias, padding = 'valid', blocksize = 1<<20):
+    """Cross-correlates a (channels, ny, nx) array with a Keras
+    (kh, kw, in, out) kernel and adds the bias, as a Conv2D layer
+    with unit strides does.
+
+    The input is flattened and unrolled (im2col) a band of rows at
+    a time, so each band is a single matrix product with the kernel
+    while the unrolled copy stays below blocksize values. The few
+    columns that wrap around the right edge are cropped at the end.
+    """
+
+    (kh, kw, cin, cout) = kernel.shape
+    if padding == 'same':
+        x = np.pad(x, ((0, 0), ((kh - 1)//2, kh//2), ((kw - 1)//2, kw//2)), mode = 'constant')
+    (c, ny, nx) = x.shape
+    (oy, ox) = (ny - kh + 1, nx - kw + 1)
+
+    flat = np.zeros((cin, ny*nx + kw - 1), dtype = np.float32)
+    flat[:, :ny*nx] = x.reshape(cin, -1)
+    kmat = kernel.transpose(3, 2, 0, 1).reshape(cout, -1)
+
+    out = np.empty((cout, oy*nx), dtype = np.float32)
+    rows = max(blocksize//(cin*kh*kw*nx), 1)
+    (cs, fs) = flat.strides
+    for r in range(0, oy, rows):
+        n = min(rows, oy - r)*nx
+        cols = as_strided(flat[:, r*nx:], shape = (cin, kh, kw, n), strides = (cs, nx*fs, fs, fs))
+        out[:, r*nx:r*nx + n] = kmat.dot(cols.reshape(cin*kh*kw, n))
+
+    out = out.reshape(cout, oy, nx)[:, :, :ox]
+    return out + bias[:, np.newaxis, np.newaxis]
+
+def exportupsampler(h5file, npzfile):
+    """Copies the layers and weights of a Keras Sequential model
+    (Conv2D, UpSampling2D and Dropout layers, channels first) from
+    an .h5 file into an .npz that upsamplenet can run.
+
+    Raises ValueError for any layer or option that upsamplenet does
+    not implement, rather than exporting a model it would run wrongly.
+    """
+
+    import h5py
+
+    def check(layer, option, value, allowed):
+        if value not in allowed:
+            raise ValueError('Cannot export ' + layer['class_name'] + ' layers with ' + option + ' = ' + str(value))
+
+    layers = []
+    weights = {}
+    with h5py.File(h5file, 'r') as f:
+        config = json.loads(f.attrs['model_config'])
+        for layer in config['config']:
+            cfg = layer['config']
+            if layer['class_name'] in ['Conv2D', 'UpSampling2D']:
+                check(layer, 'data_format', cfg.get('data_format'), ['channels_first'])
+            if layer['class_name'] == 'Conv2D':
+                check(layer, 'activation', cfg.get('activation'), ['linear', 'relu'])
+                check(layer, 'padding', cfg.get('padding'), ['same', 'valid'])
+                check(layer, 'strides', list(cfg.get('strides', [1, 1])), [[1, 1]])
+                check(layer, 'dilation_rate', list(cfg.get('dilation_rate', [1, 1])), [[1, 1]])
+                check(layer, 'use_bias', cfg.get('use_bias', True), [True])
+                g = f['model_weights'][cfg['name']][cfg['name']]
+                k = str(len(weights)//2)
+                weights['kernel' + k] = np.array(g['kernel:0'], dtype = np.float32)
+                weights['bias' + k] = np.array(g['bias:0'], dtype = np.float32)
+                layers.append('conv ' + cfg['padding'] + ' ' + cfg['activation'])
+            elif layer['class_name'] == 'UpSampling2D':
+                check(layer, 'interpolation', cfg.get('interpolation', 'nearest'), ['nearest'])
+                layers.append('up ' + str(cfg['size'][0]) + ' ' + str(cfg['size'][1]))
+            elif layer['class_name'] != 'Dropout':
+                raise ValueError('Cannot export ' + layer['class_name'] + ' layers')
+
+    np.savez(npzfile, layers = np.array(layers), **weights)
+
+class upsamplenet():
+    """The upsampling network, run with numpy alone.
+
+    Loads the layers written by exportupsampler. Dropout does nothing
+    at inference, so it is not stored. Like the Keras model, predict
+    takes and returns (n, 1, ny, nx) arrays; everything is computed
+    in float32.
+    """
+
+    def __init__(self, npzfile):
+        with np.load(npzfile) as f:
+            self.layers = [str(layer) for layer in f['layers']]
+            nconv = len([layer for layer in self.layers if layer.startswith('conv')])
+            self.weights = [(f['kernel' + str(k)], f['bias' + str(k)]) for k in range(nconv)]
+
+    def run(self, x):
+        """Upsamples one (channels, ny, nx) image."""
+        k = 0
+        for layer in self.layers:
+            params = layer.split()
+            if params[0] == 'conv':
+                x = conv2d(x, self.weights[k][0], self.weights[k][1], padding = params[1])
+                if params[2] == 'relu':
+                    np.maximum(x, 0, out = x)
+                elif params[2] != 'linear':
+                    raise ValueError('Unknown activation ' + params[2])
+                k += 1
+            elif params[0] == 'up':
+                x = x.repeat(int(params[1]), axis = 1).repeat(int(params[2]), axis = 2)
+        return x
+
+    def predict(self, imgs):
+        return np.array([self.run(img) for img in np.asarray(imgs, dtype = np.float32)])
+
+    def tiled(self, img, tile = 128, margin = 12, workers = 0):
+        """Upsamples one (ny, nx) image in overlapping tiles of about
+        tile x tile pixels, run in parallel on a pool of threads.
+
+        Each output pixel only depends on the input within about ten
+        pixels of it, so a tile padded by margin pixels gives exactly
+        the same values as the whole image over its central part. The
+        central parts are copied into the output and the rest is
+        dropped, so no blending is needed at the seams. Only the
+        output and the intermediate layers of the tiles being run are
+        held in memory at once.
+        """
+
+        (ny, nx) = img.shape
+        (oy, ox) = (self.run(np.zeros((1, 2*margin, 2*margin), dtype = np.float32)).shape[1:])
+        (cy, cx) = ((4*2*margin - oy)//2, (4*2*margin - ox)//2)
+        out = np.empty((4*ny - 2*cy, 4*nx - 2*cx), dtype = np.float32)
+
+        def runtile(r0, r1, c0, c1):
+            (a0, a1) = (max(r0 - margin, 0), min(r1 + margin, ny))
+            (b0, b1) = (max(c0 - margin, 0), min(c1 + margin, nx))
+            t = self.run(np.asarray(img[np.newaxis, a0:a1, b0:b1], dtype = np.float32))[0]
+
+            # Output pixel (y, x) of the tile is (y + 4*a0, x + 4*b0) of the whole image
+            (y0, y1) = (max(4*r0 - cy, 0), min(4*r1 - cy, out.shape[0]))
+            (x0, x1) = (max(4*c0 - cx, 0), min(4*c1 - cx, out.shape[1]))
+            out[y0:y1, x0:x1] = t[y0 - 4*a0:y1 - 4*a0, x0 - 4*b0:x1 - 4*b0]
+
+        tiles = [(r, min(r + tile, ny), c, min(c + tile, nx)) for r in range(0, ny, tile) for c in range(0, nx, tile)]
+        with ThreadPoolExecutor(max_workers = workers if workers > 0 else cpu_count()) as pool:
+            list(pool.map(lambda t: runtile(*t), tiles))
+
+        return out
+
+if __name__ == '__main__':
+    exportupsampler('upsample_model.h5', 'upsample_model.npz')
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def tokenize(data, dtype = np.float64):
+    """Converts the raw bytes of a whitespace-separated text file
+    into a flat array of numbers.
+
+    Raw STXM images contain only non-negative integer counts, so
+    the digits are converted directly with array operations. Files
+    containing anything else (signs, decimal points, exponents)
+    are handed to numpy's own text parser instead.
+    """
+
+    buf = np.frombuffer(data, dtype = np.uint8)
+    isdigit = (buf >= 48) & (buf <= 57)
+    isspace = (buf == 32) | (buf == 9) | (buf == 10) | (buf == 13)
+
+    if not np.all(isdigit | isspace):
+        return np.fromstring(data.decode('ascii'), dtype = dtype, sep = ' ')
+
+    # Locate the first and one-past-last byte of every number
+    edges = np.diff(isdigit.view(np.int8), prepend = 0, append = 0)
+    starts = np.flatnonzero(edges == 1)
+    lens = np.flatnonzero(edges == -1) - starts
+
+    # Horner's rule, one digit position at a time for all numbers
+    out = np.zeros(len(starts), dtype = dtype)
+    for k in range(lens.max() if len(lens) > 0 else 0):
+        sel = np.flatnonzero(lens > k)
+        out[sel] *= 10
+        out[sel] += buf[starts[sel] + k] - 48
+
+    return out
+
+# numpy 1.23 and later parse text files in C, which is faster than
+# anything that can be done here with array operations
+cparser = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
+
+def loadcounts(ximfile, dtype):
+    """Reads a text image with np.loadtxt, trying integer counts
+    first since they parse faster than floats."""
+    try:
+        return np.loadtxt(ximfile, dtype = np.int64, ndmin = 2).astype(dtype)
+    except ValueError:
+        return np.loadtxt(ximfile, dtype = dtype, ndmin = 2)
+
+def readxim(ximfile, shape = None, out = None, dtype = np.float64):
+    """Reads a raw STXM image (.xim) file.
+
+    The shape is (rows, columns); if it is not given (or does not
+    match the file) it is taken from the file itself. If an output
+    array is given the image is written into it in place. As with
+    np.loadtxt(ximfile)[::-1], the rows are flipped so that the
+    image displays right side up.
+
+    With numpy's C text parser the file is read by np.loadtxt;
+    on older numpy it is read in one bulk read and converted
+    with tokenize.
+    """
+
+    if cparser:
+        img = loadcounts(ximfile, dtype)[::-1]
+    else:
+        with open(ximfile, 'rb') as f:
+            data = f.read()
+
+        vals = tokenize(data, dtype = dtype)
+
+        if shape is None or np.prod(shape) != vals.size:
+            ncols = len(data.split(b'\n', 1)[0].split())
+            shape = (vals.size//max(ncols, 1), ncols)
+        img = vals.reshape(shape)[::-1]
+
+    if out is None:
+        return img
+    out[...] = img
+    return out
@@ -0,0 +1,30 @@
+import pytest
+
+from os import path
+
+from sl_io import hdrinfo
+
+hdrfile = path.join(path.dirname(path.abspath(__file__)), 'data', 'Stack_001.hdr')
+
+
+def test_hdrinfo():
+    hdr = hdrinfo(hdrfile)
+    assert hdr.scantype == 'Image Scan'
+    assert hdr.energies == [280.0, 285.5, 290.0]
+    assert hdr.shape == (4, 5)
+    assert hdr.imgids == ['000', '001', '002']
+    assert hdr.ringcurrent == [500.12, 499.87, 498.31]
+
+@pytest.mark.parametrize('cut', [2, 10, 25, 30, 36, 45])
+def test_hdrinfo_unfinished_line(tmp_path, cut):
+    # A live .hdr read while its last 'Image' line is being written;
+    # cut = 25 ends the line in the middle of the ring current
+    with open(hdrfile, 'rb') as f:
+        data = f.read()
+    livehdr = str(tmp_path / 'Stack_001.hdr')
+    with open(livehdr, 'wb') as f:
+        f.write(data[:-cut])
+    
+    hdr = hdrinfo(livehdr)
+    assert hdr.imgids == ['000', '001']
+    assert hdr.ringcurrent == [500.12, 499.87]
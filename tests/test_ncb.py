@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from os import path
+
+from sl_io import ncbwriter, savencb
+
+datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+hdrfile = path.join(datadir, 'Stack_001.hdr')
+energies = [280.0, 285.5, 290.0]
+
+# Stack_001.ncb/.dat and Stack_001_first.ncb/.dat were written by
+# the original writencb, from all of Stack_001_raw.npy and from its
+# first image. The maximum count crosses a power of ten between them.
+
+@pytest.fixture
+def rawstack():
+    return np.load(path.join(datadir, 'Stack_001_raw.npy'))
+
+def assertsame(fname, golden):
+    for ext in ['ncb', 'dat']:
+        with open(fname[:-3] + ext, 'rb') as f, open(path.join(datadir, golden + '.' + ext), 'rb') as g:
+            assert f.read() == g.read()
+
+def test_savencb(tmp_path, rawstack):
+    fname = str(tmp_path / 'out.ncb')
+    savencb(fname, hdrfile, rawstack, energies)
+    assertsame(fname, 'Stack_001')
+    
+    savencb(fname, hdrfile, rawstack[:1], energies)
+    assertsame(fname, 'Stack_001_first')
+
+def test_savencb_twice(tmp_path, rawstack):
+    fname = str(tmp_path / 'out.ncb')
+    copy = rawstack.copy()
+    savencb(fname, hdrfile, rawstack, energies)
+    savencb(fname, hdrfile, rawstack, energies)
+    assertsame(fname, 'Stack_001')
+    assert np.array_equal(rawstack, copy)
+
+def test_ncbwriter(tmp_path, rawstack):
+    fname = str(tmp_path / 'out.ncb')
+    writer = ncbwriter(fname, hdrfile, energies)
+    
+    assert writer.update(rawstack[:1]) == 1
+    assertsame(fname, 'Stack_001_first')
+    assert writer.update(rawstack[:2]) == 2
+    assert writer.update(rawstack) == 3
+    assertsame(fname, 'Stack_001')
+    assert writer.update(rawstack) == 3
+    assertsame(fname, 'Stack_001')
+
+def test_ncbwriter_ringcurrent(tmp_path, rawstack):
+    # The last ring current is not in the .hdr yet, so that frame
+    # is held back until it is. The image names in the .dat end in
+    # the last two letters of the directory, hence 'data'.
+    (tmp_path / 'data').mkdir()
+    livehdr = str(tmp_path / 'data' / 'Stack_001.hdr')
+    with open(hdrfile, 'rb') as f:
+        lines = f.read().splitlines(True)
+    with open(livehdr, 'wb') as f:
+        f.write(b''.join(lines[:-1]))
+    
+    fname = str(tmp_path / 'out.ncb')
+    writer = ncbwriter(fname, livehdr, energies)
+    assert writer.update(rawstack) == 2
+    
+    with open(livehdr, 'wb') as f:
+        f.write(b''.join(lines))
+    assert writer.update(rawstack) == 3
+    assertsame(fname, 'Stack_001')
+
+def test_ncbwriter_unfinished_hdr(tmp_path, rawstack):
+    # The .hdr is read while its last line is cut short in the middle
+    # of the ring current; that frame must wait for the whole line
+    (tmp_path / 'data').mkdir()
+    livehdr = str(tmp_path / 'data' / 'Stack_001.hdr')
+    with open(hdrfile, 'rb') as f:
+        data = f.read()
+    with open(livehdr, 'wb') as f:
+        f.write(data[:data.index(b'498.31') + 5])
+    
+    fname = str(tmp_path / 'out.ncb')
+    writer = ncbwriter(fname, livehdr, energies)
+    assert writer.update(rawstack) == 2
+    
+    with open(livehdr, 'wb') as f:
+        f.write(data)
+    assert writer.update(rawstack) == 3
+    assertsame(fname, 'Stack_001')
+
+def test_ncbwriter_changed_ringcurrent(tmp_path, rawstack):
+    # A frame written with a ring current that later changes in the
+    # .hdr is written again
+    (tmp_path / 'data').mkdir()
+    livehdr = str(tmp_path / 'data' / 'Stack_001.hdr')
+    with open(hdrfile, 'rb') as f:
+        data = f.read()
+    with open(livehdr, 'wb') as f:
+        f.write(data.replace(b'498.31', b'398.31'))
+    
+    fname = str(tmp_path / 'out.ncb')
+    writer = ncbwriter(fname, livehdr, energies)
+    assert writer.update(rawstack) == 3
+    
+    with open(livehdr, 'wb') as f:
+        f.write(data)
+    assert writer.update(rawstack) == 3
+    assertsame(fname, 'Stack_001')
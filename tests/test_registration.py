@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from scipy.ndimage import fourier_shift, gaussian_filter
+
+from sl_proc import registration
+
+
+def shiftedpair(shape, sh, seed):
+    """A smooth random reference and a copy shifted by sh (row,
+    column) pixels, with a little noise added."""
+    rng = np.random.default_rng(seed)
+    ref = gaussian_filter(rng.random(shape), 3)
+    img = np.real(np.fft.ifftn(fourier_shift(np.fft.fftn(ref), sh)))
+    return [ref, img + 0.002*rng.random(shape)]
+
+@pytest.mark.parametrize('shape', [(96, 150), (150, 96), (64, 200)])
+@pytest.mark.parametrize('levels', [1, 2])
+def test_pyramid_matches_full(shape, levels):
+    # pxwidth = 1.0 gives upsample = 100, i.e. shifts to 0.01 px
+    rng = np.random.default_rng(shape[0]*levels)
+    for k in range(10):
+        ref, img = shiftedpair(shape, rng.uniform(-6, 6, 2), k)
+        full = registration(ref, 1.0).shift(img)
+        pyramid = registration(ref, 1.0, mode = 'pyramid', levels = levels).shift(img)
+        assert np.allclose(pyramid, full, rtol = 0, atol = 1e-9)
+
+def test_refine_grid():
+    ref, img = shiftedpair((96, 150), [2.337, -4.861], 0)
+    reg = registration(ref, 1.0, mode = 'pyramid')
+    shift = np.array(reg.shift(img))
+    assert np.allclose(shift*reg.upsample, np.round(shift*reg.upsample), rtol = 0, atol = 1e-6)
+    assert np.allclose(shift, [-4.861, -2.337], rtol = 0, atol = 0.2)
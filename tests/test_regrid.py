@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from sl_proc import regridlinescan
+
+
+def oldregrid(rawimg, energies, dims):
+    """regridlinescan as it was before it was vectorised."""
+    tmp = rawimg.T
+    
+    newgrid = [tmp[0]]
+    
+    en = energies[0]
+    k = 1
+    while k < len(energies):
+        while en < energies[k]:
+            newgrid = np.append(newgrid, [tmp[k-1]], axis = 0)
+            en += 0.05
+        k += 1
+    
+    newgrid = newgrid.T
+    
+    return(newgrid)
+
+def edge(regions):
+    """Energy points of a scan made of (start, stop, step) regions."""
+    return list(np.concatenate([np.arange(*r) for r in regions]))
+
+def irregular(seed):
+    rng = np.random.default_rng(seed)
+    return list(np.round(280.0 + np.cumsum(rng.uniform(0.01, 1.5, 60)), 3))
+
+scans = {'carbon'  : edge([(280.0, 284.0, 0.5), (284.0, 290.0, 0.1), (290.0, 305.0, 0.5), (305.0, 320.0, 1.0)]),
+         'oxygen'  : edge([(525.0, 530.0, 0.5), (530.0, 540.0, 0.15), (540.0, 560.0, 1.0)]),
+         'iron'    : edge([(700.0, 705.0, 0.5), (705.0, 712.0, 0.1), (712.0, 720.0, 0.2), (720.0, 730.0, 0.5)]),
+         'uniform' : list(np.arange(280.0, 290.0, 0.05)),
+         'coarse'  : list(np.arange(280.0, 290.0, 0.1))}
+for seed in range(10):
+    scans['irregular' + str(seed)] = irregular(seed)
+
+@pytest.mark.parametrize('name', sorted(scans))
+def test_regrid(name):
+    energies = scans[name]
+    rawimg = np.arange(7*len(energies), dtype = float).reshape(7, len(energies))
+    dims = [energies[-1] - energies[0], 5.0, len(energies), 7]
+    assert np.array_equal(regridlinescan(rawimg, energies, dims), oldregrid(rawimg, energies, dims))
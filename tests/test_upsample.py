@@ -0,0 +1,95 @@
+import json
+import numpy as np
+import pytest
+
+from os import path, remove
+from scipy.signal import correlate2d
+from shutil import copyfile
+
+from sl_upsample import exportupsampler, upsamplenet
+
+rootdir = path.dirname(path.dirname(path.abspath(__file__)))
+datadir = path.join(path.dirname(path.abspath(__file__)), 'data')
+
+# upsample_input.npy is a small smooth image of detector counts, and
+# upsample_expected.npy is what reference() returned for it
+
+
+def reference(net, img):
+    """Runs the network on one (ny, nx) image in float64, one
+    kernel slice at a time with scipy, as a check on conv2d."""
+    
+    x = img[np.newaxis].astype(np.float64)
+    k = 0
+    for layer in net.layers:
+        params = layer.split()
+        if params[0] == 'conv':
+            kernel, bias = net.weights[k]
+            (kh, kw, cin, cout) = kernel.shape
+            if params[1] == 'same':
+                x = np.pad(x, ((0, 0), ((kh - 1)//2, kh//2), ((kw - 1)//2, kw//2)), mode = 'constant')
+            x = np.array([sum(correlate2d(x[i], kernel[:, :, i, o].astype(np.float64), mode = 'valid') for i in range(cin)) + bias[o]
+                          for o in range(cout)])
+            if params[2] == 'relu':
+                x = np.maximum(x, 0)
+            k += 1
+        elif params[0] == 'up':
+            x = x.repeat(int(params[1]), axis = 1).repeat(int(params[2]), axis = 2)
+    return x[0]
+
+def test_upsample_reference():
+    net = upsamplenet(path.join(rootdir, 'upsample_model.npz'))
+    img = np.load(path.join(datadir, 'upsample_input.npy'))
+    expected = np.load(path.join(datadir, 'upsample_expected.npy'))
+    
+    assert np.allclose(reference(net, img), expected, rtol = 0, atol = 1e-9*np.abs(expected).max())
+    
+    out = net.predict(img[np.newaxis, np.newaxis])
+    assert out.shape == (1, 1) + expected.shape
+    assert np.abs(out[0, 0] - expected).max() <= 1e-5*np.abs(expected).max()
+
+def test_upsample_tiled():
+    net = upsamplenet(path.join(rootdir, 'upsample_model.npz'))
+    img = np.load(path.join(datadir, 'upsample_input.npy'))
+    
+    # The same values up to float32 rounding, as the matrix
+    # products are split differently
+    whole = net.run(img[np.newaxis].astype(np.float32))[0]
+    tiled = net.tiled(img, tile = 16)
+    assert tiled.shape == whole.shape
+    assert np.abs(tiled - whole).max() <= 1e-6*np.abs(whole).max()
+
+def test_export():
+    h5py = pytest.importorskip('h5py')
+    
+    npzfile = path.join(rootdir, 'upsample_model.npz')
+    with np.load(npzfile) as f:
+        expected = dict(f)
+    
+    exportupsampler(path.join(rootdir, 'upsample_model.h5'), npzfile + '.tmp.npz')
+    try:
+        with np.load(npzfile + '.tmp.npz') as f:
+            assert sorted(f.files) == sorted(expected)
+            assert all(np.array_equal(f[k], expected[k]) for k in f.files)
+    finally:
+        remove(npzfile + '.tmp.npz')
+
+@pytest.mark.parametrize('layer, option, value', [(0, 'activation', 'sigmoid'),
+                                                  (0, 'data_format', 'channels_last'),
+                                                  (0, 'strides', [2, 2]),
+                                                  (2, 'dilation_rate', [2, 2]),
+                                                  (2, 'use_bias', False),
+                                                  (4, 'interpolation', 'bilinear'),
+                                                  (4, 'data_format', 'channels_last')])
+def test_export_unsupported(tmp_path, layer, option, value):
+    h5py = pytest.importorskip('h5py')
+    
+    h5file = str(tmp_path / 'model.h5')
+    copyfile(path.join(rootdir, 'upsample_model.h5'), h5file)
+    with h5py.File(h5file, 'r+') as f:
+        config = json.loads(f.attrs['model_config'])
+        config['config'][layer]['config'][option] = value
+        f.attrs['model_config'] = json.dumps(config)
+    
+    with pytest.raises(ValueError):
+        exportupsampler(h5file, str(tmp_path / 'model.npz'))